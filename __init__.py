@@ -47,6 +47,21 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     **MISC_NAMES,
 }
 
+# Register the Prometheus metrics route (absolute import: the nodes above share this registry)
+from lora_utils.metrics import render_prometheus
+
+try:
+    from aiohttp import web
+    from server import PromptServer
+except ImportError:
+    PromptServer = None
+
+if PromptServer is not None and getattr(PromptServer, "instance", None) is not None:
+
+    @PromptServer.instance.routes.get("/lora_stacker/metrics")
+    async def lora_stacker_metrics(request):
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
 # Register JavaScript extensions
 # Serve JS from ./js (used by this extension's frontend widgets)
 WEB_DIRECTORY = "./js"
@@ -0,0 +1 @@
+# LoRA loading and caching utilities for ComfyUI-NunchakuFluxLoraStacker
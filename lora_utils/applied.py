@@ -0,0 +1,33 @@
+"""
+This module tracks which LoRA stack is applied to a shared transformer.
+
+Every stacker node execution builds a new :class:`~wrappers.flux.ComfyFluxWrapper` around the
+same :class:`~nunchaku.NunchakuFluxTransformer2dModel`. Wrappers carrying equal
+:class:`~lora_utils.stack.LoraStackDescriptor` share the applied weights without touching the
+transformer; only a wrapper with a different stack triggers ``update_lora_params``. Such a
+switch is counted in the ``lora_stack_switches_total`` metric.
+
+Queued prompts are not reordered to group them by stack: ComfyUI executes its queue in
+submission order and gives custom nodes no hook to schedule it, so alternating stacks across
+queued prompts still cost one switch each. The switch count shows how often that happens.
+"""
+
+from lora_utils.metrics import get_registry
+from lora_utils.stack import LoraStackDescriptor
+
+
+def mark_applied(model, stack: LoraStackDescriptor) -> bool:
+    """
+    Record ``stack`` as applied to ``model`` (``model.comfy_lora_stack``) and count the switch.
+
+    Returns
+    -------
+    bool
+        True if it differs from the previously applied stack.
+    """
+    previous = getattr(model, "comfy_lora_stack", None)
+    model.comfy_lora_stack = stack
+    if stack == previous:
+        return False
+    get_registry().inc("lora_stack_switches_total")
+    return True
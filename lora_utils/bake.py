@@ -0,0 +1,199 @@
+"""
+This module bakes fixed LoRA stacks into single pre-composed ``.safetensors`` files.
+
+A baked file holds the output of :func:`~nunchaku.lora.flux.compose.compose_lora` for the
+stack, plus a manifest in its safetensors metadata (and in a ``<file>.manifest.json`` sidecar)
+listing the SHA-256, size and strength of every input. Placed in the ``loras`` folder, it can
+be selected in any stacker slot: the loaders recognise it from its metadata and use it as an
+already composed contribution, so no composition runs at sampling time. A slot strength other
+than 1.0 scales the whole baked stack.
+
+Usage::
+
+    python -m lora_utils.bake --lora-dir ComfyUI/models/loras \\
+        --lora style.safetensors:0.8 --lora detail.safetensors:0.5 -o preset.safetensors
+
+    python -m lora_utils.bake --stack preset.json -o preset.safetensors
+
+where ``preset.json`` is a list of ``{"name": ..., "strength": ...}`` objects or
+``[name, strength]`` pairs. Slots follow the FLUX LoRA Loader V2 rules: ``"None"`` and
+near-zero strengths are skipped and a repeated LoRA only counts once, even when it is a copy
+under another name.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+from collections.abc import Callable
+
+from lora_utils.fingerprint import dedupe_by_content, get_fingerprint_index
+from lora_utils.header_index import get_header_index
+
+logger = logging.getLogger(__name__)
+
+BAKED_METADATA_KEY = "lora_stacker_manifest"
+MANIFEST_VERSION = 1
+
+
+def normalize_stack(slots, resolve: Callable[[str], str]) -> list[tuple[str, float]]:
+    """
+    Apply the slot rules of FLUX LoRA Loader V2 to ``(name, strength)`` pairs.
+
+    Empty and ``"None"`` slots and strengths below 1e-5 in magnitude are dropped, and only the
+    first slot of every distinct LoRA file is kept (see
+    :func:`~lora_utils.fingerprint.dedupe_by_content`).
+
+    Parameters
+    ----------
+    slots : Iterable[tuple[str, float]]
+        ``(name, strength)`` pairs in slot order.
+    resolve : Callable[[str], str]
+        Maps a name to its path.
+    """
+    stack = [(name, float(strength)) for name, strength in slots if name and name != "None" and abs(strength) >= 1e-5]
+    return dedupe_by_content(stack, resolve)
+
+
+def build_manifest(loras: list[tuple[str, float]]) -> dict:
+    """
+    Describe the inputs of a baked stack.
+
+    Returns
+    -------
+    dict
+        ``{"version", "stack_hash", "inputs": [{"name", "sha256", "size", "strength"}, ...]}``.
+        ``stack_hash`` covers the ordered input hashes and strengths.
+    """
+    index = get_fingerprint_index()
+    inputs = [
+        {
+            "name": os.path.basename(path),
+            "sha256": index.full_hash(path, wait=True),
+            "size": os.path.getsize(path),
+            "strength": strength,
+        }
+        for path, strength in loras
+    ]
+    stack_hash = hashlib.sha256(
+        json.dumps([(i["sha256"], i["strength"]) for i in inputs], separators=(",", ":")).encode()
+    ).hexdigest()
+    return {"version": MANIFEST_VERSION, "stack_hash": stack_hash, "inputs": inputs}
+
+
+def baked_manifest(path: str) -> dict | None:
+    """
+    Return the manifest of a baked stack file, or None if ``path`` is an ordinary LoRA.
+
+    Only the safetensors header is read, through the shared header index.
+    """
+    header = get_header_index().get(path)
+    if header is None:
+        return None
+    manifest = header.metadata.get(BAKED_METADATA_KEY)
+    return None if manifest is None else json.loads(manifest)
+
+
+def is_baked(path: str) -> bool:
+    """
+    Return True if ``path`` is a stack file written by :func:`bake_stack`.
+    """
+    return baked_manifest(path) is not None
+
+
+def bake_stack(loras: list[tuple[str, float]], output: str) -> dict:
+    """
+    Compose a LoRA stack and write it with its manifest.
+
+    Parameters
+    ----------
+    loras : list[tuple[str, float]]
+        ``(path, strength)`` pairs in slot order.
+    output : str
+        Path of the ``.safetensors`` file to write. ``<output>.manifest.json`` is written next
+        to it.
+
+    Returns
+    -------
+    dict
+        The manifest.
+    """
+    from nunchaku.lora.flux.compose import compose_lora
+    from nunchaku.utils import load_state_dict_in_safetensors
+    from safetensors.torch import save_file
+
+    if not loras:
+        raise ValueError("Cannot bake an empty LoRA stack")
+    manifest = build_manifest(loras)
+    composed = compose_lora([(load_state_dict_in_safetensors(path), strength) for path, strength in loras])
+    # safetensors refuses shared or non-contiguous storage
+    tensors = {k: v.detach().to("cpu").contiguous().clone() for k, v in composed.items()}
+
+    output_dir = os.path.dirname(os.path.abspath(output))
+    os.makedirs(output_dir, exist_ok=True)
+    tmp = f"{output}.tmp{os.getpid()}"
+    save_file(tensors, tmp, metadata={BAKED_METADATA_KEY: json.dumps(manifest, separators=(",", ":"))})
+    os.replace(tmp, output)
+    with open(f"{output}.manifest.json", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _parse_lora_arg(value: str) -> tuple[str, float]:
+    name, sep, strength = value.rpartition(":")
+    if not sep:
+        return value, 1.0
+    try:
+        return name, float(strength)
+    except ValueError:
+        # a colon that is part of the path (e.g. a Windows drive letter)
+        return value, 1.0
+
+
+def load_stack_file(path: str) -> list[tuple[str, float]]:
+    """
+    Read a JSON stack definition as ``(name, strength)`` slots.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    slots = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            slots.append((entry.get("name"), float(entry.get("strength", 1.0))))
+        else:
+            name, strength = entry
+            slots.append((name, float(strength)))
+    return slots
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m lora_utils.bake", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lora", action="append", default=[], metavar="NAME[:STRENGTH]", help="LoRA slot, in order")
+    parser.add_argument("--stack", help="JSON stack definition, used before any --lora slots")
+    parser.add_argument("--lora-dir", default="", help="Directory that relative LoRA names are resolved against")
+    parser.add_argument("-o", "--output", required=True, help="Baked .safetensors file to write")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    slots = load_stack_file(args.stack) if args.stack else []
+    slots += [_parse_lora_arg(v) for v in args.lora]
+    def resolve(name):
+        return name if os.path.isabs(name) else os.path.join(args.lora_dir, name)
+
+    stack = normalize_stack(slots, resolve)
+    if not stack:
+        parser.error("the stack is empty")
+    loras = [(resolve(name), strength) for name, strength in stack]
+    for path, _ in loras:
+        if not os.path.isfile(path):
+            parser.error(f"LoRA file not found: {path}")
+
+    manifest = bake_stack(loras, args.output)
+    logger.info(f"Baked {len(loras)} LoRA(s) into {args.output} (stack {manifest['stack_hash'][:16]})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+"""
+This module plans the memory use of a LoRA stack before it is loaded, and enforces a budget.
+
+Composition concatenates the ranks of all LoRAs touching a layer, so stacking many high-rank
+LoRAs multiplies the size of the low-rank branches Nunchaku keeps on the GPU. From the
+``.safetensors`` headers alone (see :mod:`lora_utils.header_index`), :func:`plan_stack`
+predicts the composed rank of every layer, the host RAM needed while composing and the device
+memory held by the LoRA branches after ``update_lora_params``.
+
+The FLUX stacker nodes check every stack with :func:`check_stack_budget`. The budget is
+configured with environment variables:
+
+``LORA_STACKER_BUDGET_DEVICE_MB``
+    Device memory allowed for the composed LoRA branches (default 0, unlimited).
+``LORA_STACKER_BUDGET_HOST_MB``
+    Host RAM allowed while composing (default 0, unlimited).
+``LORA_STACKER_BUDGET_ACTION``
+    What to do with a stack over budget: ``warn`` (default) logs a warning, ``refuse`` raises
+    an error before anything is loaded, ``truncate`` caps the composed rank of every layer so
+    the device estimate fits (see :func:`truncate_lora_ranks`). Truncation does not lower the
+    host peak of the composition itself, so a host overrun is only reported in that mode.
+
+Truncated stacks are kept in the composed LoRA cache (see :func:`truncate_stack_ranks`), so
+switching back to a truncated stack does not repeat the factorizations.
+"""
+
+import logging
+import os
+from typing import Hashable, Iterable, NamedTuple
+
+import torch
+
+from lora_utils.compose import get_composed_cache
+from lora_utils.header_index import estimate_composed_bytes, get_header_index
+from lora_utils.metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+BUDGET_ACTIONS = ("warn", "refuse", "truncate")
+
+# Nunchaku pads low-rank branches to a multiple of this rank
+RANK_ALIGNMENT = 16
+# bytes per element of the low-rank branches on the device (FP16/BF16)
+DEVICE_ELEMENT_BYTES = 2
+
+_LAYER_PREFIXES = ("base_model.model.", "diffusion_model.", "transformer.", "lora_unet_", "lora_transformer_")
+_PAIR_SUFFIXES = ((".lora_A.weight", ".lora_B.weight"), (".lora_down.weight", ".lora_up.weight"))
+
+
+def _canonical_layer(module: str) -> str:
+    # kohya keys spell "double_blocks.0.img_attn" as "lora_unet_double_blocks_0_img_attn"
+    for prefix in _LAYER_PREFIXES:
+        if module.startswith(prefix):
+            module = module[len(prefix) :]
+            break
+    return module.replace(".", "_")
+
+
+def _aligned(rank: int) -> int:
+    return -(-rank // RANK_ALIGNMENT) * RANK_ALIGNMENT
+
+
+class StackPlan(NamedTuple):
+    """
+    Predicted memory use of a composed LoRA stack.
+
+    Attributes
+    ----------
+    layer_ranks : dict[str, tuple[int, int, int]]
+        ``layer -> (composed rank, in_features, out_features)``. LoRAs written in different
+        key formats may name the same layer differently, in which case it is listed twice.
+    host_bytes : int
+        Host RAM held while composing: the loaded LoRAs, their converted copies and the result.
+    device_bytes : int
+        Device memory of the composed low-rank branches after ``update_lora_params``.
+    """
+
+    layer_ranks: dict
+    host_bytes: int
+    device_bytes: int
+
+    @property
+    def max_rank(self) -> int:
+        return max((rank for rank, _, _ in self.layer_ranks.values()), default=0)
+
+    def device_bytes_at(self, rank_cap: int | None) -> int:
+        """
+        Device memory of the composed branches when every layer's rank is capped at ``rank_cap``.
+        """
+        total = 0
+        for rank, in_features, out_features in self.layer_ranks.values():
+            if rank_cap is not None:
+                rank = min(rank, rank_cap)
+            total += _aligned(rank) * (in_features + out_features) * DEVICE_ELEMENT_BYTES
+        return total
+
+    def rank_cap_for(self, device_budget: int) -> int | None:
+        """
+        Return the largest per-layer rank cap whose device estimate fits ``device_budget``.
+
+        Returns
+        -------
+        int or None
+            None if even rank 1 does not fit.
+        """
+        low, high = 1, self.max_rank
+        if high == 0 or self.device_bytes_at(low) > device_budget:
+            return None
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.device_bytes_at(mid) <= device_budget:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+
+def plan_stack(paths: Iterable[str]) -> StackPlan | None:
+    """
+    Predict the memory use of composing ``paths`` from their headers.
+
+    Returns
+    -------
+    StackPlan or None
+        None if a file could not be inspected (e.g. it is not a ``.safetensors`` file).
+    """
+    paths = list(paths)
+    index = get_header_index()
+    layer_ranks = {}
+    for path in paths:
+        header = index.get(path)
+        if header is None:
+            return None
+        for module, (rank, in_features, out_features) in header.ranks().items():
+            layer = _canonical_layer(module)
+            composed, _, _ = layer_ranks.get(layer, (0, 0, 0))
+            layer_ranks[layer] = (composed + rank, in_features, out_features)
+    inputs = estimate_composed_bytes(paths)
+    if inputs is None:
+        return None
+    # compose_lora converts every input to the Diffusers format before concatenating them
+    host_bytes = inputs if len(paths) <= 1 else 3 * inputs
+    plan = StackPlan(layer_ranks, host_bytes, 0)
+    return plan._replace(device_bytes=plan.device_bytes_at(None))
+
+
+def _budget_mb(name: str) -> int:
+    try:
+        return int(float(os.getenv(name, "0")) * 2**20)
+    except ValueError:
+        logger.warning(f"Ignoring invalid {name}={os.getenv(name)!r}")
+        return 0
+
+
+def budget_action() -> str:
+    """
+    Return the configured ``LORA_STACKER_BUDGET_ACTION``.
+    """
+    action = os.getenv("LORA_STACKER_BUDGET_ACTION", "warn").lower()
+    if action not in BUDGET_ACTIONS:
+        logger.warning(f"Unknown LORA_STACKER_BUDGET_ACTION={action!r}, using 'warn'")
+        return "warn"
+    return action
+
+
+def check_stack_budget(paths: Iterable[str]) -> int | None:
+    """
+    Check a stack against the configured budget and apply the configured action.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        LoRA file paths in slot order.
+
+    Returns
+    -------
+    int or None
+        Per-layer rank cap to apply with :func:`truncate_lora_ranks`, or None to apply the
+        stack unchanged.
+
+    Raises
+    ------
+    ValueError
+        If the stack is over budget and the action is ``refuse``.
+    """
+    paths = list(paths)
+    device_budget = _budget_mb("LORA_STACKER_BUDGET_DEVICE_MB")
+    host_budget = _budget_mb("LORA_STACKER_BUDGET_HOST_MB")
+    if not paths or (device_budget <= 0 and host_budget <= 0):
+        return None
+    plan = plan_stack(paths)
+    if plan is None:
+        logger.debug("Skipping the LoRA memory budget check: a file could not be inspected")
+        return None
+    logger.debug(
+        f"LoRA stack plan: max composed rank {plan.max_rank}, host {plan.host_bytes / 2**20:.0f} MiB, "
+        f"device {plan.device_bytes / 2**20:.0f} MiB"
+    )
+    over_device = 0 < device_budget < plan.device_bytes
+    over_host = 0 < host_budget < plan.host_bytes
+    if not over_device and not over_host:
+        return None
+
+    action = budget_action()
+    get_registry().inc("budget_actions_total", action=action)
+    problems = []
+    if over_device:
+        problems.append(f"device {plan.device_bytes / 2**20:.0f} MiB > {device_budget / 2**20:.0f} MiB")
+    if over_host:
+        problems.append(f"host {plan.host_bytes / 2**20:.0f} MiB > {host_budget / 2**20:.0f} MiB")
+    message = (
+        f"LoRA stack of {len(paths)} file(s) (max composed rank {plan.max_rank}) exceeds the memory budget: "
+        + ", ".join(problems)
+    )
+    if action == "refuse":
+        raise ValueError(message + ". Remove LoRAs or raise LORA_STACKER_BUDGET_DEVICE_MB / LORA_STACKER_BUDGET_HOST_MB.")
+    if action == "truncate" and over_device:
+        rank_cap = plan.rank_cap_for(device_budget)
+        if rank_cap is not None:
+            logger.warning(f"{message}; truncating every layer to rank {rank_cap}")
+            return rank_cap
+        logger.warning(f"{message}; no rank fits the device budget, applying the stack unchanged")
+        return None
+    logger.warning(message)
+    return None
+
+
+def _truncate_pair(down: torch.Tensor, up: torch.Tensor, rank: int) -> tuple[torch.Tensor, torch.Tensor]:
+    # best rank-r approximation of up @ down via two thin QRs and an SVD of the small core
+    q_down, r_down = torch.linalg.qr(down.float().T)
+    q_up, r_up = torch.linalg.qr(up.float())
+    u, s, vh = torch.linalg.svd(r_up @ r_down.T)
+    rank = min(rank, s.shape[0])
+    root = s[:rank].sqrt()
+    new_up = (q_up @ u[:, :rank]) * root
+    new_down = root[:, None] * (vh[:rank] @ q_down.T)
+    return new_down.to(down.dtype), new_up.to(up.dtype)
+
+
+def truncate_lora_ranks(state_dict: dict[str, torch.Tensor], rank_cap: int) -> dict[str, torch.Tensor]:
+    """
+    Reduce every low-rank pair of a LoRA state dict to at most ``rank_cap``.
+
+    Each pair is replaced by the best rank-``rank_cap`` approximation of its product, so the
+    strongest directions of the composed update are kept. Kohya ``alpha`` values are rescaled to
+    keep the same effective scale.
+
+    Parameters
+    ----------
+    state_dict : dict[str, torch.Tensor]
+        LoRA or composed LoRA; not modified.
+    rank_cap : int
+        Maximum rank per layer.
+
+    Returns
+    -------
+    dict[str, torch.Tensor]
+        A new dict; pairs within the cap and other tensors are shared with ``state_dict``.
+    """
+    result = dict(state_dict)
+    for key, down in state_dict.items():
+        for down_suffix, up_suffix in _PAIR_SUFFIXES:
+            if not key.endswith(down_suffix):
+                continue
+            module = key[: -len(down_suffix)]
+            up = state_dict.get(module + up_suffix)
+            rank = down.shape[0]
+            if up is None or down.ndim != 2 or up.ndim != 2 or rank <= rank_cap:
+                break
+            new_down, new_up = _truncate_pair(down, up, rank_cap)
+            result[key], result[module + up_suffix] = new_down, new_up
+            alpha = state_dict.get(module + ".alpha")
+            if alpha is not None:
+                # kohya scales by alpha / rank
+                result[module + ".alpha"] = alpha * (new_down.shape[0] / rank)
+            break
+    return result
+
+
+def truncate_stack_ranks(key: Hashable, state_dict: dict[str, torch.Tensor], rank_cap: int) -> dict[str, torch.Tensor]:
+    """
+    :func:`truncate_lora_ranks`, memoized in the composed LoRA cache under ``(key, rank_cap)``.
+
+    Parameters
+    ----------
+    key : Hashable
+        Identifies ``state_dict``, e.g. :attr:`~lora_utils.stack.LoraStackDescriptor.key` of
+        the composed stack.
+    state_dict : dict[str, torch.Tensor]
+        LoRA or composed LoRA; not modified.
+    rank_cap : int
+        Maximum rank per layer.
+
+    Returns
+    -------
+    dict[str, torch.Tensor]
+        The truncated state dict. It is shared with the cache and must not be mutated.
+    """
+    cache = get_composed_cache()
+    cache_key = ("truncated", key, rank_cap)
+    truncated = cache.get(cache_key)
+    if truncated is None:
+        truncated = truncate_lora_ranks(state_dict, rank_cap)
+        cache.put(cache_key, truncated)
+    return truncated
@@ -0,0 +1,349 @@
+"""
+This module provides a process-wide, byte-budgeted LRU cache of loaded LoRA state dicts.
+
+The FLUX LoRA loaders and LoRA Stacker V2 read LoRA files through :func:`load_lora_state_dict`,
+so a LoRA that rotates across many queued prompts is only read from disk once while it stays
+within the RAM budget. SDNQ LoRA Stacker V2 does not use the cache: it hands file paths to
+diffusers' ``load_lora_weights``, which needs the adapter config stored in the safetensors
+metadata. Entries are
+keyed by file fingerprint (see :mod:`lora_utils.fingerprint`), so a renamed file is not read
+again and a file rewritten in place is.
+
+The budget is configured with the ``LORA_STACKER_CACHE_MB`` environment variable
+(default 4096, ``0`` disables caching). With ``LORA_STACKER_MMAP=1``, ``.safetensors`` files
+are loaded as zero-copy views (see :mod:`lora_utils.safetensors_mmap`) and shared by the
+loaders above.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Any, Callable, Hashable
+
+from lora_utils.fingerprint import get_fingerprint_index
+from lora_utils.metrics import get_registry
+from lora_utils.safetensors_mmap import load_safetensors_mmap, mmap_enabled
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_MB = 4096
+
+
+def file_key(path: str) -> tuple:
+    """
+    Build a cache key identifying the current contents of a file on disk.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+
+    Returns
+    -------
+    tuple
+        Fingerprint ``("file", size, mtime_ns, partial_hash)`` from the fingerprint index.
+        A renamed file keeps its key; a replaced or rewritten file gets a new key.
+    """
+    return get_fingerprint_index().fingerprint(path)
+
+
+def state_dict_nbytes(state_dict) -> int:
+    """
+    Return the number of bytes held by the tensors of a state dict.
+    """
+    total = 0
+    for v in state_dict.values():
+        if hasattr(v, "element_size") and hasattr(v, "numel"):
+            total += v.element_size() * v.numel()
+    return total
+
+
+class LRUCache:
+    """
+    Thread-safe LRU mapping bounded by the total byte size of its values.
+
+    Parameters
+    ----------
+    max_bytes : int
+        RAM ceiling for all cached values. ``0`` disables the cache.
+    name : str, optional
+        Name used in log messages and statistics.
+    sizeof : Callable, optional
+        Function returning the byte size of a value.
+
+    Attributes
+    ----------
+    hits : int
+        Number of successful lookups.
+    misses : int
+        Number of failed lookups.
+    evictions : int
+        Number of entries dropped to stay within ``max_bytes`` or evicted explicitly.
+    """
+
+    def __init__(self, max_bytes: int, name: str = "cache", sizeof: Callable[[Any], int] = state_dict_nbytes):
+        self.name = name
+        self.max_bytes = max(0, int(max_bytes))
+        self._sizeof = sizeof
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.RLock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: Hashable, default=None):
+        """
+        Look up ``key`` and mark it as most recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value, nbytes: int | None = None) -> bool:
+        """
+        Insert ``value`` under ``key``, evicting least recently used entries as needed.
+
+        Returns
+        -------
+        bool
+            False if the value is larger than the whole budget and was not cached.
+        """
+        if nbytes is None:
+            nbytes = self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if nbytes > self.max_bytes:
+                return False
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+            self._shrink_to(self.max_bytes)
+            return True
+
+    def evict(self, key: Hashable) -> bool:
+        """
+        Explicitly remove ``key`` from the cache.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._drop(key)
+            self.evictions += 1
+            return True
+
+    def clear(self):
+        """
+        Remove all entries. Counters are kept.
+        """
+        with self._lock:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def set_max_bytes(self, max_bytes: int):
+        """
+        Change the RAM ceiling, evicting entries if the cache is now over budget.
+        """
+        with self._lock:
+            self.max_bytes = max(0, int(max_bytes))
+            self._shrink_to(self.max_bytes)
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def collect(self):
+        """
+        Report the cache statistics to the metrics registry, see
+        :meth:`~lora_utils.metrics.MetricsRegistry.register_collector`.
+        """
+        stats = self.stats()
+        labels = {"cache": self.name}
+        yield ("cache_entries", "gauge", labels, stats["entries"])
+        yield ("cache_bytes", "gauge", labels, stats["bytes"])
+        yield ("cache_max_bytes", "gauge", labels, stats["max_bytes"])
+        yield ("cache_hits_total", "counter", labels, stats["hits"])
+        yield ("cache_misses_total", "counter", labels, stats["misses"])
+        yield ("cache_evictions_total", "counter", labels, stats["evictions"])
+        yield ("cache_hit_ratio", "gauge", labels, stats["hit_ratio"])
+
+    def _drop(self, key):
+        _, nbytes = self._entries.pop(key)
+        self.current_bytes -= nbytes
+
+    def _shrink_to(self, max_bytes):
+        while self._entries and self.current_bytes > max_bytes:
+            key, (_, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+            logger.debug(f"[{self.name}] evicted {key} ({nbytes / 2**20:.1f} MiB)")
+
+
+_state_dict_cache = LRUCache(
+    int(float(os.getenv("LORA_STACKER_CACHE_MB", DEFAULT_CACHE_MB)) * 2**20),
+    name="lora_state_dicts",
+)
+get_registry().register_collector(_state_dict_cache.collect)
+
+
+# loads currently running, so concurrent requests for the same file wait instead of re-reading it
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def get_state_dict_cache() -> LRUCache:
+    """
+    Return the process-wide LoRA state dict cache.
+    """
+    return _state_dict_cache
+
+
+def load_lora_state_dict(path: str, loader: Callable[[str], dict], loader_tag: str = "default") -> dict:
+    """
+    Load a LoRA state dict through the shared cache.
+
+    Parameters
+    ----------
+    path : str
+        Path to the LoRA file.
+    loader : Callable[[str], dict]
+        Function reading the file when it is not cached, e.g.
+        :func:`nunchaku.utils.load_state_dict_in_safetensors`.
+    loader_tag : str, optional
+        Distinguishes loaders that return differently prepared state dicts for the same file.
+
+    Returns
+    -------
+    Mapping
+        Read-only view of the cached state dict. It is shared by every caller without
+        copying; pass ``dict(...)`` to code that modifies the mapping it receives.
+    """
+    if mmap_enabled() and path.endswith(".safetensors"):
+        # mmap views are identical for every loader family, so they share one entry
+        loader, loader_tag = load_safetensors_mmap, "mmap"
+    key = (loader_tag,) + file_key(path)
+    with _inflight_lock:
+        sd = _state_dict_cache.get(key)
+        if sd is not None:
+            return sd
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+
+    if not owner:
+        # another thread (usually the prefetcher) is already reading this file
+        return future.result()
+
+    try:
+        sd = MappingProxyType(loader(path))
+        _state_dict_cache.put(key, sd)
+        future.set_result(sd)
+        return sd
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+class LazyLoraStateDict(Mapping):
+    """
+    State dict of a LoRA file, read through :func:`load_lora_state_dict` on first access.
+
+    Fills the per-slot state dict lists of a transformer when its composed weights came from a
+    cache, so the lists stay aligned with the applied stack without reading any file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the LoRA file.
+    loader : Callable[[str], dict]
+        Function reading the file, as for :func:`load_lora_state_dict`.
+    loader_tag : str, optional
+        Cache namespace of ``loader``.
+    """
+
+    def __init__(self, path: str, loader: Callable[[str], dict], loader_tag: str = "default"):
+        self.path = path
+        self._loader = loader
+        self._loader_tag = loader_tag
+        self._sd = None
+
+    @property
+    def loaded(self) -> bool:
+        """
+        True once the file has been read.
+        """
+        return self._sd is not None
+
+    def resolve(self) -> Mapping:
+        """
+        Return the state dict, reading the file if needed.
+        """
+        if self._sd is None:
+            self._sd = load_lora_state_dict(self.path, self._loader, self._loader_tag)
+        return self._sd
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __repr__(self):
+        return f"LazyLoraStateDict({self.path!r}, loaded={self.loaded})"
+
+
+def evict_lora(path: str) -> int:
+    """
+    Drop every cached state dict loaded from ``path`` (or a copy of it), whatever its loader.
+
+    Returns
+    -------
+    int
+        Number of evicted entries.
+    """
+    fingerprint = get_fingerprint_index().known_fingerprint(path)
+    if fingerprint is None:
+        return 0
+    cache = _state_dict_cache
+    with cache._lock:
+        keys = [k for k in cache._entries if k[1:] == fingerprint]
+        for k in keys:
+            cache.evict(k)
+    return len(keys)
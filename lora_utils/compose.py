@@ -0,0 +1,339 @@
+"""
+This module provides memoized and incremental LoRA composition for Nunchaku FLUX models.
+
+Composed results are kept in a bounded LRU keyed by the ordered stack signature
+``(file_fingerprint, strength), ...``, so switching back to a previously
+used LoRA stack skips :func:`~nunchaku.lora.flux.compose.compose_lora` entirely.
+
+:func:`~nunchaku.lora.flux.compose.compose_lora` concatenates the ``lora_A`` matrices of all
+LoRAs along the rank dimension, concatenates the strength-scaled ``lora_B`` matrices and sums
+the strength-scaled vectors. :class:`IncrementalComposer` exploits this: each file is converted
+once into a unit-strength contribution, and a strength change only rescales that slot's
+``lora_B`` matrices and vectors before the (cheap) concatenation.
+
+With ``LORA_STACKER_DISK_CACHE_DIR`` set, composed stacks are also persisted to disk (see
+:mod:`lora_utils.disk_cache`) and survive process restarts.
+
+Stacks baked offline with :mod:`lora_utils.bake` are already in composed form and are used as
+unit-strength contributions directly.
+
+:func:`compose_stack_async` composes a stack on the LoRA I/O pool as soon as a stacker node
+executes, overlapping composition with text encoding; the first sampling step then finds the
+result in the cache.
+
+The budget is configured with the ``LORA_STACKER_COMPOSED_CACHE_MB`` environment variable
+(default 2048, ``0`` disables caching).
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from typing import Callable, Sequence
+
+import torch
+from nunchaku.lora.flux.compose import compose_lora
+from nunchaku.lora.flux.utils import is_nunchaku_format
+
+from lora_utils.bake import is_baked
+from lora_utils.cache import LRUCache, file_key, load_lora_state_dict
+from lora_utils.disk_cache import disk_key, get_disk_cache
+from lora_utils.metrics import get_registry, timed
+from lora_utils.prefetch import get_io_executor
+from lora_utils.stack import LoraStackDescriptor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COMPOSED_CACHE_MB = 2048
+
+_composed_cache = LRUCache(
+    int(float(os.getenv("LORA_STACKER_COMPOSED_CACHE_MB", DEFAULT_COMPOSED_CACHE_MB)) * 2**20),
+    name="composed_loras",
+)
+get_registry().register_collector(_composed_cache.collect)
+
+
+def get_composed_cache() -> LRUCache:
+    """
+    Return the process-wide composed LoRA cache.
+    """
+    return _composed_cache
+
+
+def stack_key(loras: Sequence[tuple[str, float]]) -> tuple:
+    """
+    Build the cache key of an ordered LoRA stack.
+
+    Parameters
+    ----------
+    loras : Sequence[tuple[str, float]] or LoraStackDescriptor
+        ``(path, strength)`` pairs in slot order.
+
+    Returns
+    -------
+    tuple
+        Ordered tuple of ``(file_key(path), strength)``. Taken from the descriptor's
+        fingerprints without touching the files when ``loras`` is a descriptor.
+    """
+    if isinstance(loras, LoraStackDescriptor):
+        return loras.key
+    return tuple((file_key(path), float(strength)) for path, strength in loras)
+
+
+def _is_unscaled_vector(key: str) -> bool:
+    # normalization weights are copied as-is by compose_lora, never scaled or summed
+    return "norm_q" in key or "norm_k" in key or "norm_added_q" in key or "norm_added_k" in key
+
+
+def _scale_contribution(unit: dict, strength: float) -> dict:
+    """
+    Turn a unit-strength contribution into the contribution at ``strength``.
+
+    ``lora_A`` matrices and normalization vectors are shared with ``unit``, not copied.
+    """
+    if strength == 1.0:
+        return unit
+    scaled = {}
+    for k, v in unit.items():
+        if v.ndim == 1:
+            scaled[k] = v if _is_unscaled_vector(k) else v * strength
+        elif "lora_B" in k:
+            scaled[k] = v * strength
+        else:
+            scaled[k] = v
+    return scaled
+
+
+class IncrementalComposer:
+    """
+    Compose LoRA stacks slot by slot, recomputing only the slots that changed.
+
+    One composer is kept per transformer. It remembers the scaled contribution of every slot
+    and the merged tensor of every key, so re-composing a stack where a single slot's strength
+    changed rescales that slot and reuses every merged tensor whose inputs are unchanged
+    (in particular all concatenated ``lora_A`` matrices). Calls are serialized, so the
+    background composition of :func:`compose_stack_async` can share the composer.
+
+    Attributes
+    ----------
+    slots : list
+        ``(slot_key, contribution)`` per slot of the last composed stack.
+    """
+
+    def __init__(self):
+        self.slots = []
+        self._merged = {}  # key -> (tuple of input tensors, merged tensor)
+        self._lock = threading.RLock()
+
+    def compose(self, loras: Sequence[tuple[str, float]], state_dicts: Sequence[dict]) -> dict:
+        """
+        Compose ``loras``, falling back to a full :func:`compose_lora` when the stack cannot
+        be merged slot by slot (Nunchaku-format inputs, conflicting keys or shapes).
+
+        Parameters
+        ----------
+        loras : Sequence[tuple[str, float]] or LoraStackDescriptor
+            ``(path, strength)`` pairs in slot order.
+        state_dicts : Sequence[dict]
+            Loaded state dicts matching ``loras``. They are not modified.
+
+        Returns
+        -------
+        dict
+            The composed LoRA state dict.
+        """
+        with self._lock:
+            if len(loras) == 0:
+                self.reset()
+                return {}
+            if any(is_nunchaku_format(sd) for sd in state_dicts):
+                self.reset()
+                return compose_lora([(dict(sd), strength) for sd, (_, strength) in zip(state_dicts, loras)])
+
+            slots = []
+            for i, ((path, strength), slot_key, sd) in enumerate(zip(loras, stack_key(loras), state_dicts)):
+                if i < len(self.slots) and self.slots[i][0] == slot_key:
+                    slots.append(self.slots[i])
+                    continue
+                slots.append((slot_key, _scale_contribution(self._unit_contribution(path, slot_key[0], sd), strength)))
+            self.slots = slots
+
+            try:
+                return self._merge([contribution for _, contribution in slots])
+            except (RuntimeError, ValueError) as e:
+                logger.debug(f"Incremental LoRA composition not possible ({e}), composing from scratch")
+                self.reset()
+                return compose_lora([(dict(sd), strength) for sd, (_, strength) in zip(state_dicts, loras)])
+
+    def reset(self):
+        """
+        Forget all per-slot state.
+        """
+        with self._lock:
+            self.slots = []
+            self._merged = {}
+
+    @staticmethod
+    def _unit_contribution(path: str, key: tuple, sd: dict) -> dict:
+        cache_key = ("unit",) + key
+        unit = _composed_cache.get(cache_key)
+        if unit is None:
+            if is_baked(path):
+                # already composed; the cache entry would only duplicate the state dict cache
+                return dict(sd)
+            # shallow copy: compose_lora converts the dict it receives in place
+            unit = compose_lora([(dict(sd), 1.0)])
+            _composed_cache.put(cache_key, unit)
+        return unit
+
+    def _merge(self, contributions: list[dict]) -> dict:
+        parts = {}
+        for contribution in contributions:
+            for k, v in contribution.items():
+                parts.setdefault(k, []).append(v)
+
+        composed = {}
+        merged = {}
+        for k, tensors in parts.items():
+            tensors = tuple(tensors)
+            previous = self._merged.get(k)
+            if (
+                previous is not None
+                and len(previous[0]) == len(tensors)
+                and all(a is b for a, b in zip(previous[0], tensors))
+            ):
+                value = previous[1]
+            elif len(tensors) == 1:
+                value = tensors[0]
+            elif tensors[0].ndim == 1:
+                if _is_unscaled_vector(k):
+                    raise ValueError(f"normalization key {k} provided by several LoRAs")
+                value = tensors[0]
+                for t in tensors[1:]:
+                    value = value + t
+            else:
+                value = torch.cat(tensors, dim=0 if "lora_A" in k else 1)
+            composed[k] = value
+            merged[k] = (tensors, value)
+        self._merged = merged
+        return composed
+
+
+def _persist(key: str, composed: dict):
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        disk_cache.put(key, composed)
+
+
+def lookup_composed(loras: Sequence[tuple[str, float]]) -> dict | None:
+    """
+    Return the composed stack from the memory or disk cache without composing it.
+
+    Parameters
+    ----------
+    loras : Sequence[tuple[str, float]] or LoraStackDescriptor
+        ``(path, strength)`` pairs in slot order.
+
+    Returns
+    -------
+    dict or None
+        The composed LoRA state dict, or None if neither cache holds it.
+    """
+    key = stack_key(loras)
+    composed = _composed_cache.get(key)
+    if composed is not None or len(key) == 0:
+        return composed
+    disk_cache = get_disk_cache()
+    if disk_cache is None:
+        return None
+    with timed("disk_cache_load_ms"):
+        composed = disk_cache.get(disk_key(key))
+    if composed is not None:
+        _composed_cache.put(key, composed)
+    return composed
+
+
+def compose_lora_stack(
+    loras: Sequence[tuple[str, float]], state_dicts: Sequence[dict], composer: IncrementalComposer | None = None
+) -> dict:
+    """
+    Compose a LoRA stack, reusing a previously composed result when available.
+
+    Parameters
+    ----------
+    loras : Sequence[tuple[str, float]] or LoraStackDescriptor
+        ``(path, strength)`` pairs in slot order.
+    state_dicts : Sequence[dict]
+        Loaded state dicts matching ``loras``. They are not modified.
+    composer : IncrementalComposer, optional
+        Per-transformer composer used on cache misses to only recompute changed slots.
+
+    Returns
+    -------
+    dict
+        The composed LoRA state dict. It is shared with the cache and must not be mutated.
+    """
+    key = stack_key(loras)
+    composed = lookup_composed(loras)
+    if composed is None:
+        if composer is None and any(is_baked(path) for path, _ in loras):
+            # baked stacks must not be converted again by compose_lora
+            composer = IncrementalComposer()
+        if composer is not None:
+            composed = composer.compose(loras, state_dicts)
+        else:
+            # shallow copies: compose_lora converts the dicts it receives in place
+            composed = compose_lora([(dict(sd), strength) for sd, (_, strength) in zip(state_dicts, loras)])
+        _composed_cache.put(key, composed)
+        if len(key) > 0 and get_disk_cache() is not None:
+            # written in the background; entries are never mutated once cached
+            get_io_executor().submit(_persist, disk_key(key), composed)
+    else:
+        logger.debug(f"Reusing composed LoRA stack of {len(loras)} LoRA(s)")
+    return composed
+
+
+def _compose_in_background(
+    stack: LoraStackDescriptor, loader: Callable[[str], dict], loader_tag: str, composer: IncrementalComposer | None
+) -> dict:
+    try:
+        composed = lookup_composed(stack)
+        if composed is not None:
+            return composed
+        state_dicts = [load_lora_state_dict(path, loader, loader_tag) for path in stack.paths]
+        return compose_lora_stack(stack, state_dicts, composer)
+    except Exception as e:
+        logger.warning(f"Failed to compose LoRA stack in the background: {e}")
+        raise
+
+
+def compose_stack_async(
+    stack: LoraStackDescriptor,
+    loader: Callable[[str], dict],
+    loader_tag: str = "default",
+    composer: IncrementalComposer | None = None,
+) -> Future | None:
+    """
+    Start loading and composing ``stack`` into the composed cache in the background.
+
+    Parameters
+    ----------
+    stack : LoraStackDescriptor
+        Stack to compose.
+    loader : Callable[[str], dict]
+        Function reading a file, as for :func:`~lora_utils.cache.load_lora_state_dict`.
+    loader_tag : str, optional
+        Cache namespace of ``loader``.
+    composer : IncrementalComposer, optional
+        Composer of the transformer the stack is meant for, so a strength sweep only
+        recomputes the changed slots.
+
+    Returns
+    -------
+    Future or None
+        Future resolving to the composed state dict, or None if there is nothing to do
+        (empty stack, disabled cache, or the stack is already composed).
+    """
+    if not stack or _composed_cache.max_bytes == 0 or stack.key in _composed_cache:
+        return None
+    return get_io_executor().submit(_compose_in_background, stack, loader, loader_tag, composer)
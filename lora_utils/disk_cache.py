@@ -0,0 +1,235 @@
+"""
+This module provides a persistent on-disk cache of composed LoRA stacks.
+
+Composed stacks are written as ``<hash>.safetensors`` files into a cache directory, where the
+hash covers the fingerprints and strengths of the stack's input files. A restarted worker (or
+another worker sharing the directory) then loads a composed stack instead of composing it
+again. Files are written to a temporary name and renamed into place, so concurrent workers
+never read a partially written entry; the least recently used entries are deleted when the
+directory exceeds its size budget.
+
+The cache is configured with environment variables:
+
+``LORA_STACKER_DISK_CACHE_DIR``
+    Cache directory (default unset, disabled).
+``LORA_STACKER_DISK_CACHE_MB``
+    Size budget of the directory (default 8192).
+
+The cache can be filled ahead of time for preset stacks::
+
+    python -m lora_utils.disk_cache --lora-dir ComfyUI/models/loras --stack preset.json [--stack ...]
+
+Entries are keyed by LoRA fingerprints (size, modification time and partial hash), so workers
+find them whatever the LoRA files are named or where they are mounted, as long as copies keep
+their modification time (e.g. ``rsync -t``).
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from lora_utils.metrics import get_registry
+from lora_utils.safetensors_mmap import load_safetensors_mmap, mmap_enabled
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DISK_CACHE_MB = 8192
+_SUFFIX = ".safetensors"
+
+
+def disk_key(stack_key: tuple) -> str:
+    """
+    Return the file name stem of a composed stack.
+
+    Parameters
+    ----------
+    stack_key : tuple
+        Ordered ``(fingerprint, strength)`` pairs, see :func:`~lora_utils.compose.stack_key`.
+    """
+    payload = json.dumps([[list(fingerprint), strength] for fingerprint, strength in stack_key], separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class DiskCache:
+    """
+    Size-bounded directory of composed LoRA stacks, safe to share between processes.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory; created if missing.
+    max_bytes : int
+        Size budget. Least recently used entries are deleted beyond it.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key: str) -> dict | None:
+        """
+        Load the composed stack stored under ``key``, or return None.
+        """
+        path = self.path_for(key)
+        try:
+            if mmap_enabled():
+                state_dict = load_safetensors_mmap(path)
+            else:
+                from safetensors.torch import load_file
+
+                state_dict = load_file(path)
+        except FileNotFoundError:
+            get_registry().inc("disk_cache_lookups_total", result="miss")
+            return None
+        except Exception as e:
+            logger.warning(f"Dropping unreadable disk cache entry {path}: {e}")
+            self._remove(path)
+            get_registry().inc("disk_cache_lookups_total", result="miss")
+            return None
+        try:
+            # the modification time doubles as the last-use time for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        get_registry().inc("disk_cache_lookups_total", result="hit")
+        return state_dict
+
+    def put(self, key: str, state_dict: dict) -> bool:
+        """
+        Store ``state_dict`` under ``key`` atomically, then enforce the size budget.
+
+        Returns
+        -------
+        bool
+            False if the entry could not be written.
+        """
+        from safetensors.torch import save_file
+
+        path = self.path_for(key)
+        if os.path.exists(path):
+            return True
+        # safetensors refuses shared or non-contiguous storage
+        tensors = {k: v.detach().to("cpu").contiguous().clone() for k, v in state_dict.items()}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=f".{key[:16]}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            save_file(tensors, tmp)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning(f"Failed to write disk cache entry {path}: {e}")
+            self._remove(tmp)
+            return False
+        get_registry().inc("disk_cache_writes_total")
+        self.evict_to_budget()
+        return True
+
+    def evict_to_budget(self) -> int:
+        """
+        Delete least recently used entries until the directory fits the budget.
+
+        Returns
+        -------
+        int
+            Number of deleted entries.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(_SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # removed by another worker
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if self._remove(path):
+                    removed += 1
+                total -= size
+            if removed:
+                get_registry().inc("disk_cache_evictions_total", removed)
+            return removed
+
+    def _remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+_disk_cache = None
+_disk_cache_dir = None
+
+
+def get_disk_cache() -> DiskCache | None:
+    """
+    Return the disk cache configured by ``LORA_STACKER_DISK_CACHE_DIR``, or None if unset.
+    """
+    global _disk_cache, _disk_cache_dir
+    directory = os.getenv("LORA_STACKER_DISK_CACHE_DIR", "")
+    if not directory:
+        return None
+    if _disk_cache is None or _disk_cache_dir != directory:
+        max_mb = float(os.getenv("LORA_STACKER_DISK_CACHE_MB", DEFAULT_DISK_CACHE_MB))
+        _disk_cache = DiskCache(directory, int(max_mb * 2**20))
+        _disk_cache_dir = directory
+    return _disk_cache
+
+
+def main(argv=None) -> int:
+    from nunchaku.utils import load_state_dict_in_safetensors
+
+    from lora_utils.bake import load_stack_file, normalize_stack
+    from lora_utils.compose import compose_lora_stack, lookup_composed
+    from lora_utils.prefetch import get_io_executor
+    from lora_utils.stack import LoraStackDescriptor
+
+    parser = argparse.ArgumentParser(prog="python -m lora_utils.disk_cache", description="Warm up the composed LoRA disk cache.")
+    parser.add_argument("--stack", action="append", required=True, help="JSON stack definition (repeatable)")
+    parser.add_argument("--lora-dir", default="", help="Directory that relative LoRA names are resolved against")
+    parser.add_argument("--cache-dir", help="Cache directory (default: LORA_STACKER_DISK_CACHE_DIR)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.cache_dir:
+        os.environ["LORA_STACKER_DISK_CACHE_DIR"] = args.cache_dir
+    if get_disk_cache() is None:
+        parser.error("no cache directory: pass --cache-dir or set LORA_STACKER_DISK_CACHE_DIR")
+
+    def resolve(name):
+        return name if os.path.isabs(name) else os.path.abspath(os.path.join(args.lora_dir, name))
+
+    for stack_file in args.stack:
+        stack = normalize_stack(load_stack_file(stack_file), resolve)
+        loras = [(resolve(n), s) for n, s in stack]
+        descriptor = LoraStackDescriptor.from_loras(loras)
+        if lookup_composed(descriptor) is not None:
+            logger.info(f"{stack_file}: already cached")
+            continue
+        start = time.perf_counter()
+        compose_lora_stack(descriptor, [load_state_dict_in_safetensors(p) for p in descriptor.paths])
+        logger.info(f"{stack_file}: composed {len(descriptor)} LoRA(s) in {time.perf_counter() - start:.1f}s")
+    # composed stacks are written by the I/O pool
+    get_io_executor().shutdown(wait=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,308 @@
+"""
+This module identifies LoRA files by content through a persistent fingerprint index.
+
+Every file gets a fast *partial hash*: SHA-256 over its size and three 1 MiB samples (head,
+middle, tail). Together with the size and modification time, that is the file's fingerprint
+``("file", size, mtime_ns, partial_hash)``, used as the key of every cache in this package.
+Files that differ only outside the samples therefore never share cache entries, and a file
+rewritten in place gets a new fingerprint even if its size is unchanged. A renamed file, or a
+copy that kept its modification time (``cp -p``, ``rsync -t``), is still recognised as the same
+LoRA and loaded once.
+
+The full SHA-256 of each file is computed lazily on a low-priority background thread and
+stored next to the partial hash (see :meth:`FingerprintIndex.full_hash`). Stacker slots are
+only merged as duplicates (see :func:`dedupe_by_content`) when their full hashes match.
+
+Records ``path -> (size, mtime_ns, partial_hash, full_hash)`` are kept in an SQLite database
+so they survive restarts; only new or modified files are hashed again. The database location
+is configured with ``LORA_STACKER_INDEX_DB`` (default
+``~/.cache/comfyui_lora_stacker/fingerprints.sqlite3``, empty keeps the index in memory).
+``LORA_STACKER_FULL_HASH=0`` disables background full hashing.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_BYTES = 1 << 20
+
+_DEFAULT_DB = os.path.join(os.path.expanduser("~"), ".cache", "comfyui_lora_stacker", "fingerprints.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    partial_hash TEXT NOT NULL,
+    full_hash TEXT
+)
+"""
+
+
+class FileRecord(NamedTuple):
+    path: str
+    size: int
+    mtime_ns: int
+    partial_hash: str
+    full_hash: str | None
+
+    @property
+    def fingerprint(self) -> tuple:
+        return ("file", self.size, self.mtime_ns, self.partial_hash)
+
+
+def partial_hash(path: str, size: int) -> str:
+    """
+    Hash the size and the head, middle and tail samples of a file.
+    """
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        if size <= 3 * SAMPLE_BYTES:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - SAMPLE_BYTES) // 2, size - SAMPLE_BYTES):
+                f.seek(offset)
+                digest.update(f.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+def full_hash(path: str, chunk_size: int = 1 << 24) -> str:
+    """
+    Return the hex SHA-256 of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FingerprintIndex:
+    """
+    Thread-safe ``path -> FileRecord`` index backed by SQLite.
+
+    Parameters
+    ----------
+    db_path : str, optional
+        Database file, shared safely by several processes. None keeps records in memory only.
+    full_hash_in_background : bool, optional
+        Compute full hashes of newly indexed files on a background thread.
+    """
+
+    def __init__(self, db_path: str | None = None, full_hash_in_background: bool = True):
+        self.db_path = db_path
+        self._records = {}  # resolved path -> FileRecord
+        self._lock = threading.RLock()
+        self._conn = None
+        self._full_hash_in_background = full_hash_in_background
+        self._hasher = None
+        self._pending = {}  # resolved path -> Future of its full hash
+        if db_path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+                self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(_SCHEMA)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Fingerprint index {db_path} unavailable, keeping it in memory: {e}")
+                self._conn = None
+
+    def lookup(self, path: str) -> FileRecord:
+        """
+        Return the record of ``path``, hashing the file if it is new or was modified.
+
+        Raises
+        ------
+        OSError
+            If the file cannot be read.
+        """
+        resolved = os.path.realpath(path)
+        st = os.stat(resolved)
+        with self._lock:
+            record = self._records.get(resolved)
+            if record is None:
+                record = self._load(resolved)
+            if record is not None and record.size == st.st_size and record.mtime_ns == st.st_mtime_ns:
+                return record
+
+        # hash outside the lock; a concurrent lookup of the same file computes the same record
+        record = FileRecord(resolved, st.st_size, st.st_mtime_ns, partial_hash(resolved, st.st_size), None)
+        with self._lock:
+            self._records[resolved] = record
+            self._store(record)
+        if self._full_hash_in_background:
+            self._schedule_full_hash(record)
+        return record
+
+    def fingerprint(self, path: str) -> tuple:
+        """
+        Return the fingerprint ``("file", size, mtime_ns, partial_hash)`` of ``path``.
+        """
+        return self.lookup(path).fingerprint
+
+    def known_fingerprint(self, path: str) -> tuple | None:
+        """
+        Return the last indexed fingerprint of ``path`` without touching the file.
+        """
+        resolved = os.path.realpath(path)
+        with self._lock:
+            record = self._records.get(resolved) or self._load(resolved)
+        return None if record is None else record.fingerprint
+
+    def full_hash(self, path: str, wait: bool = False) -> str | None:
+        """
+        Return the full SHA-256 of ``path``.
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Compute it now if it is not known yet. Otherwise return None and leave it to the
+            background thread.
+        """
+        record = self.lookup(path)
+        if record.full_hash is not None:
+            return record.full_hash
+        if not wait:
+            self._schedule_full_hash(record)
+            return None
+        return self._compute_full_hash(record)
+
+    def _schedule_full_hash(self, record: FileRecord) -> Future | None:
+        with self._lock:
+            future = self._pending.get(record.path)
+            if future is not None:
+                return future
+            if self._hasher is None:
+                # a single thread, so hashing never competes with LoRA reads for more than one core
+                self._hasher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lora_hash")
+            future = self._pending[record.path] = self._hasher.submit(self._compute_full_hash, record)
+        return future
+
+    def _compute_full_hash(self, record: FileRecord) -> str | None:
+        try:
+            digest = full_hash(record.path)
+        except OSError as e:
+            logger.debug(f"Could not hash {record.path}: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(record.path, None)
+        with self._lock:
+            current = self._records.get(record.path)
+            # drop the result if the file changed while it was being hashed
+            if current is not None and current[:4] == record[:4]:
+                current = current._replace(full_hash=digest)
+                self._records[record.path] = current
+                self._store(current)
+        return digest
+
+    def _load(self, resolved: str) -> FileRecord | None:
+        if self._conn is None:
+            return None
+        try:
+            row = self._conn.execute(
+                "SELECT path, size, mtime_ns, partial_hash, full_hash FROM files WHERE path = ?", (resolved,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.debug(f"Fingerprint index read failed: {e}")
+            return None
+        if row is None:
+            return None
+        record = self._records[resolved] = FileRecord(*row)
+        return record
+
+    def _store(self, record: FileRecord):
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", tuple(record))
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.debug(f"Fingerprint index write failed: {e}")
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_fingerprint_index() -> FingerprintIndex:
+    """
+    Return the process-wide fingerprint index, opening its database on first use.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = FingerprintIndex(
+                os.getenv("LORA_STACKER_INDEX_DB", _DEFAULT_DB) or None,
+                full_hash_in_background=os.getenv("LORA_STACKER_FULL_HASH", "1").lower() not in ("0", "false", "no", "off"),
+            )
+        return _index
+
+
+def fingerprint(path: str) -> tuple:
+    """
+    Return the fingerprint of ``path``, see :meth:`FingerprintIndex.fingerprint`.
+    """
+    return get_fingerprint_index().fingerprint(path)
+
+
+def _same_content(index: FingerprintIndex, a: FileRecord, b: FileRecord) -> bool:
+    if a.path == b.path:
+        return True
+    if a.size != b.size or a.partial_hash != b.partial_hash:
+        return False
+    digest = index.full_hash(a.path, wait=True)
+    return digest is not None and digest == index.full_hash(b.path, wait=True)
+
+
+def dedupe_by_content(slots: Iterable[tuple[str, float]], resolve: Callable[[str], str]) -> list[tuple[str, float]]:
+    """
+    Drop stacker slots whose file has the same content as an earlier slot.
+
+    Candidates are found by size and partial hash and confirmed with the full SHA-256, computed
+    now if the background thread has not got to it yet.
+
+    Parameters
+    ----------
+    slots : Iterable[tuple[str, float]]
+        ``(name, strength)`` pairs in slot order.
+    resolve : Callable[[str], str]
+        Maps a name to its path, e.g. ``lambda n: folder_paths.get_full_path_or_raise("loras", n)``.
+
+    Returns
+    -------
+    list[tuple[str, float]]
+        The first slot of every distinct LoRA. Slots whose file cannot be read are kept, so
+        the caller reports the error.
+    """
+    index = get_fingerprint_index()
+    kept = []
+    unreadable = set()
+    records = []  # records of the kept, readable slots
+    for name, strength in slots:
+        try:
+            record = index.lookup(resolve(name))
+        except (OSError, ValueError):
+            record = None
+        if record is None:
+            duplicate = name in unreadable
+            unreadable.add(name)
+        else:
+            duplicate = any(_same_content(index, record, other) for other in records)
+            if not duplicate:
+                records.append(record)
+        if duplicate:
+            logger.debug(f"Skipping {name}: same content as an earlier LoRA slot")
+            continue
+        kept.append((name, strength))
+    return kept
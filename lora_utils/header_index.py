@@ -0,0 +1,239 @@
+"""
+This module provides a header-only index of LoRA files.
+
+A ``.safetensors`` header lists every tensor's key, dtype, shape and byte range, which is
+enough to know which layers a LoRA touches, its rank per layer and how much memory it needs,
+without reading any tensor bytes. :class:`HeaderIndex` parses headers on demand and caches
+them by file fingerprint.
+
+The stacker nodes use it to validate a stack before loading it (see :func:`validate_stack`)
+and to estimate the size of the composed result (see :func:`estimate_composed_bytes`).
+"""
+
+import logging
+import re
+import struct
+import threading
+from collections import OrderedDict
+from typing import Iterable, NamedTuple
+
+from lora_utils.fingerprint import get_fingerprint_index
+from lora_utils.safetensors_mmap import read_safetensors_header
+
+logger = logging.getLogger(__name__)
+
+# "<module>.lora_A.weight", "<module>.lora_down.weight", "<module>.lora_A.default.weight", ...
+_DOWN_KEY = re.compile(r"^(?P<module>.+)\.(?:lora_A|lora_down)(?:\.default)?\.weight$")
+_UP_SUFFIXES = (".lora_B.weight", ".lora_up.weight", ".lora_B.default.weight")
+
+# substrings of the transformer block names used by every FLUX LoRA key format
+_FLUX_BLOCK_NAMES = ("double_blocks", "single_blocks", "transformer_blocks")
+
+DEFAULT_MAX_ENTRIES = 4096
+
+
+class TensorInfo(NamedTuple):
+    dtype: str
+    shape: tuple
+    data_offsets: tuple
+
+    @property
+    def nbytes(self) -> int:
+        begin, end = self.data_offsets
+        return end - begin
+
+
+class LoraHeader:
+    """
+    Parsed header of one LoRA file.
+
+    Attributes
+    ----------
+    path : str
+        Path the header was read from.
+    fingerprint : tuple
+        Content fingerprint of the file.
+    tensors : dict[str, TensorInfo]
+        Tensor descriptions by key.
+    metadata : dict[str, str]
+        The ``__metadata__`` entry of the header.
+    """
+
+    __slots__ = ("path", "fingerprint", "tensors", "metadata", "_ranks")
+
+    def __init__(self, path: str, fingerprint: tuple, header: dict):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.metadata = header.pop("__metadata__", None) or {}
+        self.tensors = {
+            key: TensorInfo(info["dtype"], tuple(info["shape"]), tuple(info["data_offsets"])) for key, info in header.items()
+        }
+        self._ranks = None
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Total size of the tensor data.
+        """
+        return sum(t.nbytes for t in self.tensors.values())
+
+    def ranks(self) -> dict[str, tuple[int, int, int]]:
+        """
+        Return ``module -> (rank, in_features, out_features)`` for every low-rank pair.
+        """
+        if self._ranks is None:
+            ranks = {}
+            for key, info in self.tensors.items():
+                match = _DOWN_KEY.match(key)
+                if match is None or len(info.shape) < 2:
+                    continue
+                module = match.group("module")
+                out_features = 0
+                for up_suffix in _UP_SUFFIXES:
+                    up = self.tensors.get(module + up_suffix)
+                    if up is not None:
+                        out_features = up.shape[0]
+                        break
+                ranks[module] = (info.shape[0], info.shape[1], out_features)
+            self._ranks = ranks
+        return self._ranks
+
+    @property
+    def is_lora(self) -> bool:
+        return len(self.ranks()) > 0
+
+    @property
+    def is_flux(self) -> bool:
+        """
+        True if the LoRA targets FLUX transformer blocks (in any supported key format).
+        """
+        return any(name in key for key in self.tensors for name in _FLUX_BLOCK_NAMES)
+
+    @property
+    def x_embedder_in_channels(self) -> int | None:
+        """
+        Input channels of the LoRA on the image embedder, if it has one.
+
+        FLUX Fill / depth / canny LoRAs widen the embedder input, which the wrapper must match.
+        """
+        for module, (_, in_features, _) in self.ranks().items():
+            if module.endswith("x_embedder") or module.endswith("img_in"):
+                return in_features
+        return None
+
+
+class HeaderIndex:
+    """
+    Thread-safe cache of parsed LoRA headers keyed by file fingerprint.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+        Number of headers kept (they are small, typically a few hundred kilobytes).
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> LoraHeader | None:
+        """
+        Return the header of ``path``, or None if it is not a readable ``.safetensors`` file.
+        """
+        if not path.endswith(".safetensors"):
+            return None
+        try:
+            fingerprint = get_fingerprint_index().fingerprint(path)
+        except OSError as e:
+            logger.debug(f"Cannot index {path}: {e}")
+            return None
+        with self._lock:
+            header = self._entries.get(fingerprint)
+            if header is not None:
+                self._entries.move_to_end(fingerprint)
+                return header
+        try:
+            raw, _ = read_safetensors_header(path)
+            header = LoraHeader(path, fingerprint, raw)
+        except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+            logger.debug(f"Cannot read safetensors header of {path}: {e}")
+            return None
+        with self._lock:
+            self._entries[fingerprint] = header
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return header
+
+
+_header_index = HeaderIndex()
+
+
+def get_header_index() -> HeaderIndex:
+    """
+    Return the process-wide header index.
+    """
+    return _header_index
+
+
+def validate_stack(paths: Iterable[str]) -> list[str]:
+    """
+    Check a FLUX LoRA stack for problems visible in the file headers.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        LoRA file paths in slot order.
+
+    Returns
+    -------
+    list[str]
+        Human-readable problems; empty if none were found. Files that are not
+        ``.safetensors`` cannot be inspected and are not reported.
+    """
+    problems = []
+    in_channels = {}
+    for path in paths:
+        if not path.endswith(".safetensors"):
+            continue
+        header = _header_index.get(path)
+        if header is None:
+            problems.append(f"{path}: unreadable safetensors header")
+            continue
+        if not header.is_lora:
+            if header.tensors:
+                # pre-converted (Nunchaku-format) or baked files do not follow the lora_A/lora_B naming
+                logger.debug(f"{path}: no low-rank pairs found in the header")
+            else:
+                problems.append(f"{path}: contains no tensors")
+            continue
+        if not header.is_flux:
+            problems.append(f"{path}: does not look like a FLUX LoRA (no FLUX transformer block keys)")
+        channels = header.x_embedder_in_channels
+        if channels is not None:
+            in_channels[path] = channels
+    if len(set(in_channels.values())) > 1:
+        detail = ", ".join(f"{p} ({c})" for p, c in in_channels.items())
+        problems.append(f"LoRAs expect different image embedder input channels: {detail}")
+    return problems
+
+
+def estimate_composed_bytes(paths: Iterable[str]) -> int | None:
+    """
+    Estimate the size of the composed state dict of a stack from the headers alone.
+
+    Composition concatenates the low-rank matrices of all LoRAs and sums their vectors, so the
+    result is about as large as the inputs together.
+
+    Returns
+    -------
+    int or None
+        Estimated bytes, or None if a file could not be inspected.
+    """
+    total = 0
+    for path in paths:
+        header = _header_index.get(path)
+        if header is None:
+            return None
+        total += header.nbytes
+    return total
@@ -0,0 +1,207 @@
+"""
+This module provides a small in-process metrics registry for LoRA loading and sampling.
+
+Counters and timing histograms are recorded by the caches, the stacker nodes and
+:class:`~wrappers.flux.ComfyFluxWrapper`. They can be read at any time with
+:func:`get_registry` ``().snapshot()``, or scraped in the Prometheus text exposition format
+from the ``/lora_stacker/metrics`` route that the package registers on the ComfyUI server
+(see :func:`render_prometheus`).
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+METRIC_PREFIX = "lora_stacker_"
+
+# histogram bucket upper bounds, in milliseconds
+DEFAULT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class TimingStats:
+    """
+    Running summary and histogram of a timed operation, in milliseconds.
+    """
+
+    __slots__ = ("count", "total_ms", "max_ms", "last_ms", "bucket_counts")
+
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_ms = 0.0
+        self.bucket_counts = [0] * len(DEFAULT_BUCKETS_MS)
+
+    def observe(self, ms: float):
+        self.count += 1
+        self.total_ms += ms
+        self.last_ms = ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+        i = bisect.bisect_left(DEFAULT_BUCKETS_MS, ms)
+        if i < len(self.bucket_counts):
+            self.bucket_counts[i] += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": self.total_ms,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "max_ms": self.max_ms,
+            "last_ms": self.last_ms,
+        }
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class MetricsRegistry:
+    """
+    Thread-safe registry of named counters, timings and collectors.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._timings = {}
+        self._collectors = []
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Add ``value`` to the counter ``name`` with the given labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, ms: float):
+        """
+        Record one duration of ``name`` in milliseconds.
+        """
+        with self._lock:
+            stats = self._timings.get(name)
+            if stats is None:
+                stats = self._timings[name] = TimingStats()
+            stats.observe(ms)
+
+    def register_collector(self, collector: Callable[[], Iterable[tuple[str, str, dict, float]]]):
+        """
+        Register a callable reporting ``(name, kind, labels, value)`` tuples at scrape time,
+        where ``kind`` is ``"counter"`` or ``"gauge"``. Used for values owned by other objects,
+        such as cache statistics.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        """
+        Return a copy of all counters, timing summaries and collected values.
+        """
+        with self._lock:
+            counters = {name + _format_labels(labels): v for (name, labels), v in self._counters.items()}
+            timings = {name: stats.as_dict() for name, stats in self._timings.items()}
+            collectors = list(self._collectors)
+        collected = {}
+        for collector in collectors:
+            for name, _, labels, value in collector():
+                collected[name + _format_labels(sorted(labels.items()))] = value
+        return {"counters": counters, "timings": timings, "collected": collected}
+
+    def render_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted((name, stats.count, stats.total_ms, list(stats.bucket_counts)) for name, stats in self._timings.items())
+            collectors = list(self._collectors)
+
+        typed = set()
+        for (name, labels), value in counters:
+            full = METRIC_PREFIX + name
+            if full not in typed:
+                lines.append(f"# TYPE {full} counter")
+                typed.add(full)
+            lines.append(f"{full}{_format_labels(labels)} {value}")
+
+        for name, count, total_ms, bucket_counts in timings:
+            full = METRIC_PREFIX + name
+            lines.append(f"# TYPE {full} histogram")
+            cumulative = 0
+            for bound, n in zip(DEFAULT_BUCKETS_MS, bucket_counts):
+                cumulative += n
+                lines.append(f'{full}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{full}_bucket{{le="+Inf"}} {count}')
+            lines.append(f"{full}_sum {total_ms}")
+            lines.append(f"{full}_count {count}")
+
+        # samples of one metric must be contiguous, whichever collector reported them
+        collected = sorted(
+            (name, kind, tuple(sorted(labels.items())), value)
+            for collector in collectors
+            for name, kind, labels, value in collector()
+        )
+        for name, kind, labels, value in collected:
+            full = METRIC_PREFIX + name
+            if full not in typed:
+                lines.append(f"# TYPE {full} {kind}")
+                typed.add(full)
+            lines.append(f"{full}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        """
+        Clear all counters and timings. Collectors stay registered.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry() -> MetricsRegistry:
+    """
+    Return the process-wide metrics registry.
+    """
+    return _registry
+
+
+def render_prometheus() -> str:
+    """
+    Render the process-wide registry in the Prometheus text exposition format.
+    """
+    return _registry.render_prometheus()
+
+
+@contextmanager
+def timed(name: str, record: dict | None = None):
+    """
+    Time the enclosed block and record it in the registry as ``name``.
+
+    Parameters
+    ----------
+    name : str
+        Timing name, e.g. ``"compose_ms"``.
+    record : dict, optional
+        Per-call record that also receives ``record[name] = elapsed_ms``.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - start) * 1000.0
+        _registry.observe(name, ms)
+        if record is not None:
+            record[name] = ms
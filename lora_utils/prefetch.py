@@ -0,0 +1,120 @@
+"""
+This module provides background prefetching and parallel loading of LoRA files.
+
+Stacker nodes only record LoRA paths; the files are read during the first sampling step.
+:func:`prefetch_lora` starts reading and parsing a file into the shared state dict cache as
+soon as the node executes, and :func:`~lora_utils.cache.load_lora_state_dict` waits on the
+running read instead of starting a second one.
+
+:func:`load_loras_parallel` reads all missing slots of a stack concurrently through the same
+bounded pool, which suits latency-bound NVMe storage.
+
+The pool size is configured with the ``LORA_STACKER_IO_WORKERS`` environment variable (default 4).
+"""
+
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Sequence
+
+from lora_utils.cache import get_state_dict_cache, load_lora_state_dict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IO_WORKERS = 4
+
+_executor = None
+
+
+def get_io_executor() -> ThreadPoolExecutor:
+    """
+    Return the shared LoRA I/O thread pool, creating it on first use.
+    """
+    global _executor
+    if _executor is None:
+        workers = max(1, int(os.getenv("LORA_STACKER_IO_WORKERS", DEFAULT_IO_WORKERS)))
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lora_io")
+    return _executor
+
+
+def _prefetch(path: str, loader: Callable[[str], dict], loader_tag: str) -> dict:
+    try:
+        return load_lora_state_dict(path, loader, loader_tag)
+    except Exception as e:
+        # a forward waiting on this read gets the same exception
+        logger.warning(f"Failed to prefetch LoRA {path}: {e}")
+        raise
+
+
+def prefetch_lora(path: str, loader: Callable[[str], dict], loader_tag: str = "default") -> Future | None:
+    """
+    Start loading a LoRA file into the shared cache in the background.
+
+    Parameters
+    ----------
+    path : str
+        Path to the LoRA file.
+    loader : Callable[[str], dict]
+        Function reading the file, as for :func:`~lora_utils.cache.load_lora_state_dict`.
+    loader_tag : str, optional
+        Cache namespace of ``loader``.
+
+    Returns
+    -------
+    Future or None
+        Future resolving to the state dict, or None when the cache is disabled
+        (a prefetched state dict would be dropped immediately).
+    """
+    if get_state_dict_cache().max_bytes == 0:
+        return None
+    return get_io_executor().submit(_prefetch, path, loader, loader_tag)
+
+
+def load_loras_parallel(
+    paths: Sequence[str], loader: Callable[[str], dict], loader_tag: str = "default"
+) -> list[dict]:
+    """
+    Load several LoRA files concurrently through the shared cache and I/O pool.
+
+    Parameters
+    ----------
+    paths : Sequence[str]
+        LoRA file paths in slot order.
+    loader : Callable[[str], dict]
+        Function reading a file, as for :func:`~lora_utils.cache.load_lora_state_dict`.
+    loader_tag : str, optional
+        Cache namespace of ``loader``.
+
+    Returns
+    -------
+    list[dict]
+        State dicts in the same order as ``paths``.
+
+    Raises
+    ------
+    RuntimeError
+        For the first slot (in slot order) that failed to load, after all reads finished.
+        Failures of later slots are logged.
+    """
+    if len(paths) == 0:
+        return []
+    if len(paths) == 1:
+        return [load_lora_state_dict(paths[0], loader, loader_tag)]
+
+    executor = get_io_executor()
+    futures = [executor.submit(load_lora_state_dict, path, loader, loader_tag) for path in paths]
+    results = []
+    first_error = None
+    for i, (path, future) in enumerate(zip(paths, futures)):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            error = RuntimeError(f"Failed to load LoRA slot {i + 1} ({path}): {e}")
+            error.__cause__ = e
+            if first_error is None:
+                first_error = error
+            else:
+                logger.error(str(error))
+    if first_error is not None:
+        raise first_error
+    return results
@@ -0,0 +1,131 @@
+"""
+This module provides memory-mapped, zero-copy loading of ``.safetensors`` LoRA files.
+
+Tensors returned by :func:`load_safetensors_mmap` are views over a private (copy-on-write)
+mapping of the file, so no tensor bytes are copied until something writes to them or converts
+them. Pages that are only read stay shared with the OS page cache, which lets several ComfyUI
+workers on one host use the same physical memory for the same LoRA.
+
+The mode is enabled with the ``LORA_STACKER_MMAP=1`` environment variable.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    _DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    _DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+
+def mmap_enabled() -> bool:
+    """
+    Return True if LoRA files should be loaded with :func:`load_safetensors_mmap`.
+    """
+    return os.getenv("LORA_STACKER_MMAP", "0").lower() in ("1", "true", "yes", "on")
+
+
+def read_safetensors_header(path: str) -> tuple[dict, int]:
+    """
+    Read the JSON header of a ``.safetensors`` file without touching tensor data.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+
+    Returns
+    -------
+    header : dict
+        Parsed header. Tensor entries map a key to ``{"dtype", "shape", "data_offsets"}``;
+        the optional ``"__metadata__"`` entry holds string metadata.
+    data_start : int
+        Absolute file offset of the tensor data section.
+
+    Raises
+    ------
+    ValueError
+        If the file is too short or its header is not a JSON object.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        prefix = f.read(8)
+        if len(prefix) < 8:
+            raise ValueError(f"{path} is too short for a safetensors file ({size} bytes)")
+        (header_len,) = struct.unpack("<Q", prefix)
+        if header_len > size - 8:
+            raise ValueError(f"{path}: header length {header_len} exceeds the file size ({size} bytes)")
+        header = json.loads(f.read(header_len))
+    if not isinstance(header, dict):
+        raise ValueError(f"{path}: safetensors header is not a JSON object")
+    return header, 8 + header_len
+
+
+def load_safetensors_mmap(path: str) -> dict[str, torch.Tensor]:
+    """
+    Load a ``.safetensors`` file as tensors viewing a copy-on-write memory map.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+
+    Returns
+    -------
+    dict[str, torch.Tensor]
+        CPU tensors keyed by name. Tensors whose offset is not aligned to their element size
+        are copied instead; tensors with a dtype this module does not map (e.g. ``U16``) are
+        read, and copied, through :func:`safetensors.safe_open`.
+    """
+    header, data_start = read_safetensors_header(path)
+    header.pop("__metadata__", None)
+
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    state_dict = {}
+    unmapped = []
+    for key, info in header.items():
+        dtype = _DTYPES.get(info["dtype"])
+        shape = info["shape"]
+        begin, end = info["data_offsets"]
+        offset = data_start + begin
+        if dtype is None:
+            unmapped.append(key)
+            continue
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        count = (end - begin) // itemsize
+        if count == 0:
+            state_dict[key] = torch.empty(shape, dtype=dtype)
+        elif offset % itemsize != 0:
+            state_dict[key] = torch.frombuffer(bytearray(buffer[offset:offset + end - begin]), dtype=dtype).reshape(shape)
+        else:
+            # the tensor keeps a reference to the mapping, which stays open as long as it is used
+            state_dict[key] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+    if unmapped:
+        from safetensors import safe_open
+
+        logger.debug(f"Copying {len(unmapped)} tensor(s) with unmapped dtypes from {path}")
+        with safe_open(path, framework="pt", device="cpu") as f:
+            for key in unmapped:
+                state_dict[key] = f.get_tensor(key)
+    return state_dict
@@ -0,0 +1,103 @@
+"""
+This module provides :class:`LoraStackDescriptor`, the immutable identity of an ordered LoRA stack.
+
+Stacker nodes build a descriptor once per execution, fingerprinting every file. It is stored
+on :class:`~wrappers.flux.ComfyFluxWrapper` and, once applied, on the transformer. A sampling
+step compares it with the applied descriptor by identity or hash, which also notices files
+replaced in place. Only when the descriptors match does it check the transformer's meta list
+slot by slot, as ComfyUI-nunchaku's own wrapper may have changed the LoRAs in between without
+knowing about descriptors.
+"""
+
+from typing import Iterable, Iterator
+
+from lora_utils.cache import file_key
+
+
+class LoraStackDescriptor:
+    """
+    Immutable, hashable description of an ordered LoRA stack.
+
+    Two descriptors are equal when they list the same files (by fingerprint) with the
+    same strengths in the same order.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        LoRA file paths in slot order.
+    strengths : Iterable[float]
+        Strength of each slot.
+    fingerprints : Iterable[tuple], optional
+        :func:`~lora_utils.cache.file_key` of each path. Computed from the files when omitted.
+
+    Attributes
+    ----------
+    paths : tuple[str, ...]
+        LoRA file paths in slot order.
+    fingerprints : tuple[tuple, ...]
+        Content fingerprint of each file when the descriptor was built.
+    strengths : tuple[float, ...]
+        Strength of each slot.
+    """
+
+    __slots__ = ("paths", "fingerprints", "strengths", "_key", "_hash")
+
+    def __init__(self, paths: Iterable[str], strengths: Iterable[float], fingerprints: Iterable[tuple] | None = None):
+        paths = tuple(paths)
+        strengths = tuple(float(s) for s in strengths)
+        if len(paths) != len(strengths):
+            raise ValueError(f"Got {len(paths)} LoRA paths but {len(strengths)} strengths")
+        fingerprints = tuple(file_key(p) for p in paths) if fingerprints is None else tuple(fingerprints)
+        object.__setattr__(self, "paths", paths)
+        object.__setattr__(self, "fingerprints", fingerprints)
+        object.__setattr__(self, "strengths", strengths)
+        object.__setattr__(self, "_key", tuple(zip(fingerprints, strengths)))
+        object.__setattr__(self, "_hash", hash(self._key))
+
+    @classmethod
+    def from_loras(cls, loras: Iterable[tuple[str, float]]) -> "LoraStackDescriptor":
+        """
+        Build a descriptor from ``(path, strength)`` pairs.
+        """
+        if isinstance(loras, cls):
+            return loras
+        loras = list(loras)
+        return cls([path for path, _ in loras], [strength for _, strength in loras])
+
+    @property
+    def key(self) -> tuple:
+        """
+        Ordered tuple of ``(fingerprint, strength)``, as returned by
+        :func:`~lora_utils.compose.stack_key`.
+        """
+        return self._key
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __iter__(self) -> Iterator[tuple[str, float]]:
+        # (path, strength) pairs, like the lists the wrapper used to hold
+        return iter(zip(self.paths, self.strengths))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __bool__(self):
+        return len(self.paths) > 0
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, LoraStackDescriptor):
+            return NotImplemented
+        return self._hash == other._hash and self._key == other._key
+
+    def __repr__(self):
+        slots = ", ".join(f"({p!r}, {s})" for p, s in self)
+        return f"{type(self).__name__}([{slots}])"
+
+
+EMPTY_STACK = LoraStackDescriptor((), ())
@@ -0,0 +1,217 @@
+"""
+This module stages LoRA tensors in reusable pinned host memory and uploads them to the device
+on a side stream.
+
+Composed LoRA tensors are ordinary (pageable) CPU tensors, so copying them to the GPU is
+synchronous. :class:`PinnedStagingPool` copies them into a small set of reusable pinned arenas
+instead, from which :func:`upload_async` issues non-blocking copies on a dedicated CUDA stream.
+The compute stream only waits for them on the device.
+
+:class:`~wrappers.flux.ComfyFluxWrapper` uses it while applying a new stack in ``forward``, on
+CUDA devices only. It stages the unquantized-part tensors (embedders, ``norm_out`` and
+``proj_out``), which ``update_lora_params`` would otherwise move with a blocking copy, so their
+upload overlaps with Nunchaku's host-side conversion of the transformer blocks. Those are
+usually a small fraction of a stack's bytes: the block tensors, the bulk of it, are converted
+and uploaded by Nunchaku itself and do not go through the pool.
+
+The number of arenas is configured with the ``LORA_STACKER_STAGING_ARENAS`` environment
+variable (default 2, ``0`` disables staging).
+"""
+
+import logging
+import os
+import threading
+
+import torch
+
+from lora_utils.metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STAGING_ARENAS = 2
+
+# byte alignment of every tensor inside an arena, a multiple of all element sizes
+_ALIGN = 64
+
+
+def _aligned(nbytes: int) -> int:
+    return (nbytes + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class _Arena:
+    __slots__ = ("buffer", "event", "in_use")
+
+    def __init__(self):
+        self.buffer = None
+        self.event = None  # last upload reading from the buffer
+        self.in_use = False
+
+
+class StagingLease:
+    """
+    Handle on an arena holding staged tensors. The tensors stay valid until :meth:`release`.
+    """
+
+    def __init__(self, pool: "PinnedStagingPool", arena: _Arena | None):
+        self._pool = pool
+        self._arena = arena
+
+    def release(self, event=None):
+        """
+        Return the arena to the pool.
+
+        Parameters
+        ----------
+        event : torch.cuda.Event, optional
+            Event recorded after the last copy reading from the arena; the arena is not
+            overwritten before it completes.
+        """
+        if self._arena is not None:
+            self._pool._release(self._arena, event)
+            self._arena = None
+
+
+class PinnedStagingPool:
+    """
+    Round-robin pool of reusable staging arenas, pinned when CUDA is available.
+
+    Parameters
+    ----------
+    num_arenas : int
+        Number of arenas. Two allow staging the next stack while the previous upload runs.
+    """
+
+    def __init__(self, num_arenas: int = DEFAULT_STAGING_ARENAS):
+        self.pinned = torch.cuda.is_available()
+        self._arenas = [_Arena() for _ in range(max(0, int(num_arenas)))]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Total size of the allocated arenas.
+        """
+        return sum(a.buffer.numel() for a in self._arenas if a.buffer is not None)
+
+    def stage(self, tensors: dict[str, torch.Tensor]) -> tuple[dict[str, torch.Tensor], StagingLease]:
+        """
+        Copy CPU tensors into a staging arena.
+
+        Parameters
+        ----------
+        tensors : dict[str, torch.Tensor]
+            CPU tensors to stage. They are not modified.
+
+        Returns
+        -------
+        staged : dict[str, torch.Tensor]
+            Copies of ``tensors`` viewing the arena.
+        lease : StagingLease
+            Must be released once the staged tensors are no longer read.
+        """
+        total = sum(_aligned(t.numel() * t.element_size()) for t in tensors.values())
+        arena = self._acquire(total)
+        if arena is None:
+            # every arena is leased: stage into a one-off buffer rather than wait
+            get_registry().inc("staging_arena_misses_total")
+            buffer = torch.empty(total, dtype=torch.uint8, pin_memory=self.pinned)
+        else:
+            buffer = arena.buffer
+
+        staged = {}
+        offset = 0
+        for k, t in tensors.items():
+            nbytes = t.numel() * t.element_size()
+            view = buffer[offset:offset + nbytes].view(t.dtype).view(t.shape)
+            view.copy_(t)
+            staged[k] = view
+            offset += _aligned(nbytes)
+        return staged, StagingLease(self, arena)
+
+    def _acquire(self, nbytes: int) -> _Arena | None:
+        with self._lock:
+            for _ in range(len(self._arenas)):
+                arena = self._arenas[self._next]
+                self._next = (self._next + 1) % len(self._arenas)
+                if not arena.in_use:
+                    arena.in_use = True
+                    break
+            else:
+                return None
+        if arena.event is not None:
+            arena.event.synchronize()
+            arena.event = None
+        if arena.buffer is None or arena.buffer.numel() < nbytes:
+            # grow to the largest stack seen so far; smaller stacks reuse the buffer
+            arena.buffer = None
+            arena.buffer = torch.empty(nbytes, dtype=torch.uint8, pin_memory=self.pinned)
+            logger.debug(f"Allocated {nbytes / 2**20:.1f} MiB staging arena (pinned={self.pinned})")
+        return arena
+
+    def _release(self, arena: _Arena, event):
+        with self._lock:
+            arena.event = event
+            arena.in_use = False
+
+
+_staging_pool = None
+_side_streams = {}
+_side_streams_lock = threading.Lock()
+
+
+def get_staging_pool() -> PinnedStagingPool | None:
+    """
+    Return the process-wide staging pool, or None when ``LORA_STACKER_STAGING_ARENAS`` is 0.
+    """
+    global _staging_pool
+    if _staging_pool is None:
+        num_arenas = int(os.getenv("LORA_STACKER_STAGING_ARENAS", DEFAULT_STAGING_ARENAS))
+        if num_arenas <= 0:
+            return None
+        _staging_pool = PinnedStagingPool(num_arenas)
+    return _staging_pool
+
+
+def _side_stream(device: torch.device):
+    with _side_streams_lock:
+        stream = _side_streams.get(device)
+        if stream is None:
+            stream = _side_streams[device] = torch.cuda.Stream(device=device)
+        return stream
+
+
+def upload_async(tensors: dict[str, torch.Tensor], device: torch.device) -> tuple[dict[str, torch.Tensor], object]:
+    """
+    Copy tensors to ``device`` on a side stream without blocking the host.
+
+    The current stream of ``device`` is made to wait for the copies, so kernels queued on it
+    afterwards see the uploaded data.
+
+    Parameters
+    ----------
+    tensors : dict[str, torch.Tensor]
+        Host tensors, ideally pinned (pageable tensors are copied synchronously).
+    device : torch.device
+        Target device.
+
+    Returns
+    -------
+    uploaded : dict[str, torch.Tensor]
+        Device tensors, or ``tensors`` unchanged when ``device`` is not a CUDA device.
+    event : torch.cuda.Event or None
+        Completes when the copies are done; pass it to :meth:`StagingLease.release`.
+    """
+    if device.type != "cuda" or not torch.cuda.is_available():
+        return tensors, None
+    stream = _side_stream(device)
+    compute_stream = torch.cuda.current_stream(device)
+    with torch.cuda.stream(stream):
+        uploaded = {k: v.to(device, non_blocking=True) for k, v in tensors.items()}
+        event = torch.cuda.Event()
+        event.record(stream)
+    for v in uploaded.values():
+        # allocated on the side stream but consumed on the compute stream
+        v.record_stream(compute_stream)
+    compute_stream.wait_event(event)
+    return uploaded, event
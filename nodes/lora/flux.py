@@ -19,6 +19,14 @@ custom_node_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspat
 if custom_node_dir not in sys.path:
     sys.path.insert(0, custom_node_dir)
 
+from lora_utils.applied import mark_applied
+from lora_utils.budget import check_stack_budget, truncate_stack_ranks
+from lora_utils.compose import compose_lora_stack
+from lora_utils.fingerprint import dedupe_by_content
+from lora_utils.header_index import validate_stack
+from lora_utils.metrics import get_registry, timed
+from lora_utils.prefetch import load_loras_parallel
+from lora_utils.stack import EMPTY_STACK, LoraStackDescriptor
 from wrappers.flux import ComfyFluxWrapper
 
 # Get log level from environment variable (default to INFO)
@@ -176,6 +184,8 @@ class NunchakuFluxLoraStack:
         tuple
             A tuple containing the modified diffusion model.
         """
+        get_registry().inc("stacker_executions_total", node=type(self).__name__)
+
         # Collect LoRA information to apply
         loras_to_apply = []
 
@@ -203,15 +213,19 @@ class NunchakuFluxLoraStack:
 
             loras_to_apply.append((lora_name, lora_strength))
 
-        # Step 3: Format LoRA list (deduplicate, filter empty)
-        loras_formatted = []
-        seen = set()
-        for lora_name, lora_strength in loras_to_apply:
-            if lora_name and lora_name not in seen:
-                loras_formatted.append((lora_name, lora_strength))
-                seen.add(lora_name)
+        # Step 3: Format LoRA list (filter empty, deduplicate by file content)
+        loras_formatted = dedupe_by_content(
+            [(n, s) for n, s in loras_to_apply if n], lambda n: folder_paths.get_full_path_or_raise("loras", n)
+        )
+
+        logger.debug(f"Applying {len(loras_formatted)} LoRAs")
 
-        print(f"DEBUG: Applying {len(loras_formatted)} LoRAs")
+        # Header-only checks: nothing has been read from the LoRA files yet
+        lora_paths = [folder_paths.get_full_path_or_raise("loras", n) for n, _ in loras_formatted]
+        for problem in validate_stack(lora_paths):
+            logger.warning(f"LoRA stack: {problem}")
+        # raises before anything is loaded when the stack is over budget and the action is "refuse"
+        rank_cap = check_stack_budget(lora_paths)
 
         # Step 1: Extract actual model from OptimizedModule if needed
         model_wrapper = model.model.diffusion_model
@@ -219,7 +233,7 @@ class NunchakuFluxLoraStack:
 
         # Step 2: Determine model type
         wrapper_class_name = type(actual_model_wrapper).__name__
-        print(f"DEBUG: Detected model type: {wrapper_class_name}")
+        logger.debug(f"Detected model type: {wrapper_class_name}")
 
         if wrapper_class_name not in ("ComfyFluxWrapper", "NunchakuFluxTransformer2dModel"):
             raise ValueError(
@@ -257,39 +271,58 @@ class NunchakuFluxLoraStack:
 
         # Step 4: Handle ComfyFluxWrapper case
         if wrapper_class_name == "ComfyFluxWrapper":
-            print("DEBUG: Using ComfyFluxWrapper LoRA application method")
-            ret_model_wrapper.loras = []
-
+            logger.debug("Using ComfyFluxWrapper LoRA application method")
+            lora_tuples = []
             for lora_name, lora_strength in loras_formatted:
                 lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
-                ret_model_wrapper.loras.append((lora_path, lora_strength))
-                print(f"DEBUG: Added LoRA {lora_name} with strength {lora_strength}")
+                lora_tuples.append((lora_path, lora_strength))
+                logger.debug(f"Added LoRA {lora_name} with strength {lora_strength}")
+            ret_model_wrapper.lora_stack = LoraStackDescriptor.from_loras(lora_tuples)
+            ret_model_wrapper.lora_rank_cap = rank_cap
+            ret_model_wrapper.prefetch_loras()
 
         # Step 5: Handle NunchakuFluxTransformer2dModel case
         elif wrapper_class_name == "NunchakuFluxTransformer2dModel":
-            print("DEBUG: Using NunchakuFluxTransformer2dModel LoRA application method")
+            logger.debug("Using NunchakuFluxTransformer2dModel LoRA application method")
 
             if loras_formatted:
-                from nunchaku.lora.flux.compose import compose_lora as nunchaku_compose_lora
+                from nunchaku.utils import load_state_dict_in_safetensors
 
                 lora_tuples = []
                 for lora_name, lora_strength in loras_formatted:
                     lora_path = folder_paths.get_full_path_or_raise("loras", lora_name)
                     lora_tuples.append((lora_path, lora_strength))
-                    print(f"DEBUG: Preparing LoRA {lora_name} at {lora_path}")
+                    logger.debug(f"Preparing LoRA {lora_name} at {lora_path}")
+                lora_stack = LoraStackDescriptor.from_loras(lora_tuples)
+                with timed("disk_load_ms"):
+                    lora_sds = load_loras_parallel(lora_stack.paths, load_state_dict_in_safetensors, "nunchaku")
 
                 if len(lora_tuples) == 1:
                     lora_path, lora_strength = lora_tuples[0]
-                    ret_model_wrapper.update_lora_params(lora_path)
+                    lora_sd = lora_sds[0]
+                    if rank_cap is not None:
+                        # the strength is applied separately, so the result only depends on the file
+                        lora_sd = truncate_stack_ranks(lora_stack.fingerprints, lora_sd, rank_cap)
+                    # shallow copy: nunchaku converters may replace entries of the dict they receive
+                    lora_sd = dict(lora_sd)
+                    with timed("update_lora_params_ms"):
+                        ret_model_wrapper.update_lora_params(lora_sd)
                     ret_model_wrapper.set_lora_strength(lora_strength)
-                    print(f"DEBUG: Applied single LoRA with strength {lora_strength}")
+                    logger.debug(f"Applied single LoRA with strength {lora_strength}")
                 else:
-                    composed_lora = nunchaku_compose_lora(lora_tuples)
-                    ret_model_wrapper.update_lora_params(composed_lora)
-                    print(f"DEBUG: Applied {len(lora_tuples)} composed LoRAs")
+                    with timed("compose_ms"):
+                        composed_lora = compose_lora_stack(lora_stack, lora_sds)
+                    if rank_cap is not None:
+                        with timed("rank_truncate_ms"):
+                            composed_lora = truncate_stack_ranks(lora_stack.key, composed_lora, rank_cap)
+                    with timed("update_lora_params_ms"):
+                        ret_model_wrapper.update_lora_params(composed_lora)
+                    logger.debug(f"Applied {len(lora_tuples)} composed LoRAs")
+                mark_applied(ret_model_wrapper, lora_stack)
             else:
                 ret_model_wrapper.update_lora_params(None)
-                print("DEBUG: Cleared LoRA params")
+                mark_applied(ret_model_wrapper, EMPTY_STACK)
+                logger.debug("Cleared LoRA params")
 
         # Step 6: Validate returned model
         ret_wrapper_class_name = type(ret_model_wrapper).__name__
@@ -299,5 +332,5 @@ class NunchakuFluxLoraStack:
                 f"got {type(ret_model_wrapper)}"
             )
 
-        print(f"DEBUG: Successfully applied LoRA using {ret_wrapper_class_name}")
+        logger.debug(f"Successfully applied LoRA using {ret_wrapper_class_name}")
         return (ret_model,)
@@ -14,6 +14,14 @@ if custom_node_dir not in sys.path:
 
 import folder_paths
 
+from lora_utils.applied import mark_applied
+from lora_utils.budget import check_stack_budget, truncate_stack_ranks
+from lora_utils.compose import compose_lora_stack
+from lora_utils.fingerprint import dedupe_by_content
+from lora_utils.header_index import validate_stack
+from lora_utils.metrics import get_registry, timed
+from lora_utils.prefetch import load_loras_parallel
+from lora_utils.stack import EMPTY_STACK, LoraStackDescriptor
 from wrappers.flux import ComfyFluxWrapper
 
 log_level = os.getenv("LOG_LEVEL", "INFO").upper()
@@ -53,6 +61,7 @@ class FluxLoraMultiLoaderBase:
     CATEGORY = "FLUX/MultiLoader" 
 
     def load_lora_stack(self, model, **kwargs):
+        get_registry().inc("stacker_executions_total", node=type(self).__name__)
         loras_to_apply = []
         for i in range(1, self._slot_count + 1):
             lora_name = kwargs.get(f"lora_name_{i}")
@@ -71,13 +80,15 @@ class FluxLoraMultiLoaderBase:
             if abs(strength) < 1e-5: continue
             loras_to_apply.append((lora_name, strength))
 
-        # Deduplicate
-        loras_formatted = []
-        seen = set()
-        for name, strength in loras_to_apply:
-            if name not in seen:
-                loras_formatted.append((name, strength))
-                seen.add(name)
+        # Deduplicate (by file content, so copies under another name count once)
+        loras_formatted = dedupe_by_content(loras_to_apply, lambda n: folder_paths.get_full_path_or_raise("loras", n))
+
+        # Header-only checks: nothing has been read from the LoRA files yet
+        lora_paths = [folder_paths.get_full_path_or_raise("loras", n) for n, _ in loras_formatted]
+        for problem in validate_stack(lora_paths):
+            logger.warning(f"LoRA stack: {problem}")
+        # raises before anything is loaded when the stack is over budget and the action is "refuse"
+        rank_cap = check_stack_budget(lora_paths)
 
         model_wrapper = model.model.diffusion_model
         actual_wrapper = model_wrapper._orig_mod if hasattr(model_wrapper, "_orig_mod") else model_wrapper
@@ -114,21 +125,41 @@ class FluxLoraMultiLoaderBase:
                 ret_wrapper = new_wrapper
 
         if wrapper_class == "ComfyFluxWrapper":
-            ret_wrapper.loras = []
-            for name, strength in loras_formatted:
-                path = folder_paths.get_full_path_or_raise("loras", name)
-                ret_wrapper.loras.append((path, strength))
+            ret_wrapper.lora_stack = LoraStackDescriptor.from_loras(
+                (folder_paths.get_full_path_or_raise("loras", name), strength) for name, strength in loras_formatted
+            )
+            ret_wrapper.lora_rank_cap = rank_cap
+            ret_wrapper.prefetch_loras()
         elif wrapper_class == "NunchakuFluxTransformer2dModel":
             if loras_formatted:
-                from nunchaku.lora.flux.compose import compose_lora
-                tuples = [(folder_paths.get_full_path_or_raise("loras", n), s) for n, s in loras_formatted]
-                if len(tuples) == 1:
-                    ret_wrapper.update_lora_params(tuples[0][0])
-                    ret_wrapper.set_lora_strength(tuples[0][1])
+                from nunchaku.utils import load_state_dict_in_safetensors
+                stack = LoraStackDescriptor.from_loras(
+                    (folder_paths.get_full_path_or_raise("loras", n), s) for n, s in loras_formatted
+                )
+                with timed("disk_load_ms"):
+                    sds = load_loras_parallel(stack.paths, load_state_dict_in_safetensors, "nunchaku")
+                if len(stack) == 1:
+                    sd = sds[0]
+                    if rank_cap is not None:
+                        # the strength is applied separately, so the result only depends on the file
+                        sd = truncate_stack_ranks(stack.fingerprints, sd, rank_cap)
+                    # shallow copy: nunchaku converters may replace entries of the dict they receive
+                    sd = dict(sd)
+                    with timed("update_lora_params_ms"):
+                        ret_wrapper.update_lora_params(sd)
+                    ret_wrapper.set_lora_strength(stack.strengths[0])
                 else:
-                    ret_wrapper.update_lora_params(compose_lora(tuples))
+                    with timed("compose_ms"):
+                        composed = compose_lora_stack(stack, sds)
+                    if rank_cap is not None:
+                        with timed("rank_truncate_ms"):
+                            composed = truncate_stack_ranks(stack.key, composed, rank_cap)
+                    with timed("update_lora_params_ms"):
+                        ret_wrapper.update_lora_params(composed)
+                mark_applied(ret_wrapper, stack)
             else:
                 ret_wrapper.update_lora_params(None)
+                mark_applied(ret_wrapper, EMPTY_STACK)
         
         return (ret_model,)
 
@@ -14,10 +14,13 @@ custom_node_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspat
 if custom_node_dir not in sys.path:
     sys.path.insert(0, custom_node_dir)
 
+from lora_utils.metrics import get_registry
+
 log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=getattr(logging, log_level, logging.INFO), format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+
 class StandardLoraLoaderBase:
     """Base class for fixed-slot LoRA loaders (diffusers format)."""
     
@@ -82,6 +85,7 @@ class StandardLoraLoaderBase:
         Returns:
             Tuple containing (MODEL,) with LoRAs applied
         """
+        get_registry().inc("stacker_executions_total", node=type(self).__name__)
         # Unload all existing LoRA adapters first to avoid name conflicts
         try:
             if hasattr(model, 'peft_config') and model.peft_config:
@@ -130,7 +134,8 @@ class StandardLoraLoaderBase:
                         print(f"[SDNQ LoRA Stacker] Warning: Could not unload existing adapter {adapter_name}: {e}")
                     
                     if is_local_file:
-                        # Local .safetensors file
+                        # Local file, loaded by path: diffusers reads the adapter config from
+                        # the safetensors metadata, which a bare state dict would not carry
                         lora_dir = os.path.dirname(lora_path)
                         lora_file = os.path.basename(lora_path)
                         
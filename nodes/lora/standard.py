@@ -14,18 +14,24 @@ custom_node_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspat
 if custom_node_dir not in sys.path:
     sys.path.insert(0, custom_node_dir)
 
+from lora_utils.fingerprint import dedupe_by_content
+from lora_utils.metrics import get_registry
+from lora_utils.prefetch import load_loras_parallel
+
 log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=getattr(logging, log_level, logging.INFO), format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+
+def _load_torch_file(path):
+    return comfy.utils.load_torch_file(path, safe_load=True)
+
+
 class StandardLoraLoaderBase:
     """Base class for fixed-slot LoRA loaders."""
     
     _slot_count = 0
 
-    def __init__(self):
-        self.loaded_lora = None
-
     @classmethod
     def INPUT_TYPES(cls):
         loras = ["None"] + folder_paths.get_filename_list("loras")
@@ -50,6 +56,7 @@ class StandardLoraLoaderBase:
     CATEGORY = "loaders" 
 
     def load_lora_stack(self, model, clip, **kwargs):
+        get_registry().inc("stacker_executions_total", node=type(self).__name__)
         loras_to_apply = []
         for i in range(1, self._slot_count + 1):
             lora_name = kwargs.get(f"lora_name_{i}")
@@ -61,35 +68,21 @@ class StandardLoraLoaderBase:
             if abs(strength) < 1e-5: continue
             loras_to_apply.append((lora_name, strength))
 
-        # Deduplicate
-        loras_formatted = []
-        seen = set()
-        for name, strength in loras_to_apply:
-            if name not in seen:
-                loras_formatted.append((name, strength))
-                seen.add(name)
+        # Deduplicate (by file content, so copies under another name count once)
+        loras_formatted = dedupe_by_content(loras_to_apply, lambda n: folder_paths.get_full_path_or_raise("loras", n))
 
         # CHANGED: Use ComfyUI standard LoRA loading (copied from nodes.py)
         current_model = model
         current_clip = clip
         
-        for name, strength in loras_formatted:
-            if strength == 0:
-                continue
-
-            lora_path = folder_paths.get_full_path_or_raise("loras", name)
-            lora = None
-            if self.loaded_lora is not None:
-                if self.loaded_lora[0] == lora_path:
-                    lora = self.loaded_lora[1]
-                else:
-                    self.loaded_lora = None
-
-            if lora is None:
-                lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
-                self.loaded_lora = (lora_path, lora)
-
-            current_model, current_clip = comfy.sd.load_lora_for_models(current_model, current_clip, lora, strength, strength)
+        loras_formatted = [(name, strength) for name, strength in loras_formatted if strength != 0]
+        lora_paths = [folder_paths.get_full_path_or_raise("loras", name) for name, _ in loras_formatted]
+        # read all files concurrently, then apply them in slot order
+        lora_sds = load_loras_parallel(lora_paths, _load_torch_file, "comfy")
+
+        for (name, strength), lora in zip(loras_formatted, lora_sds):
+            # shallow copy: ComfyUI's LoRA format converters may rename keys in place
+            current_model, current_clip = comfy.sd.load_lora_for_models(current_model, current_clip, dict(lora), strength, strength)
         
         return (current_model, current_clip)
 
@@ -0,0 +1,136 @@
+"""
+Benchmark of the LoRA apply path of ``ComfyFluxWrapper`` on CPU, with a fake transformer.
+
+Compares the original LoRA handling of ``ComfyFluxWrapper.forward`` (per-slot state dicts
+re-read whenever a slot's path changes, a dict copy of every slot before each
+``compose_lora``) with the current :meth:`~wrappers.flux.ComfyFluxWrapper._update_loras`
+(shared state dict cache, composed-stack cache and incremental composition). Both end in
+``update_lora_params`` of :class:`fakes.FakeFluxTransformer`; PuLID handling is left out.
+
+Scenarios:
+
+``sweep``
+    Only the strength of the last slot changes between applies; every stack is new.
+``switch``
+    Alternates between two stacks of different files.
+
+Each scenario runs twice per path: once for the timing, once under an allocation counter
+(ATen tensor allocations) and ``tracemalloc`` (Python heap peak).
+
+Usage::
+
+    python tests/bench_lora_apply.py [--loras 10] [--keys 3000] [--applies 6]
+"""
+
+import argparse
+import tempfile
+import time
+import tracemalloc
+
+import fakes
+
+fakes.install()
+
+import torch  # noqa: E402
+from bench_patchify import AllocationCounter  # noqa: E402
+
+from lora_utils.cache import get_state_dict_cache  # noqa: E402
+from lora_utils.compose import get_composed_cache  # noqa: E402
+from wrappers.flux import ComfyFluxWrapper  # noqa: E402
+
+
+def sweep_schedule(paths, applies, run):
+    # distinct strengths per run, so the second run does not hit the composed cache
+    strengths = [0.5 + (run * applies + i) / (4 * applies) for i in range(applies + 1)]
+    return [[(p, 1.0) for p in paths[:-1]] + [(paths[-1], s)] for s in strengths]
+
+
+def switch_schedule(paths, applies, run):
+    half = len(paths) // 2
+    a = [(p, 1.0) for p in paths[:half]]
+    b = [(p, 0.8) for p in paths[half:]]
+    return [a if i % 2 == 0 else b for i in range(applies + 1)]
+
+
+def original_apply():
+    def apply(model, loras):
+        fakes.nunchaku_wrapper_step(model, loras)
+
+    return apply
+
+
+def current_apply():
+    wrapper = None
+
+    def apply(model, loras):
+        nonlocal wrapper
+        if wrapper is None:
+            wrapper = ComfyFluxWrapper(model, config={"patch_size": 2, "guidance_embed": False})
+        wrapper.loras = loras
+        wrapper._update_loras(model, {})
+
+    return apply
+
+
+def measure(make_apply, schedule) -> dict:
+    get_state_dict_cache().clear()
+    get_composed_cache().clear()
+
+    model = fakes.FakeFluxTransformer()
+    apply = make_apply()
+    stacks = schedule(0)
+    apply(model, stacks[0])  # warm up: first load of the files
+    start = time.perf_counter()
+    for loras in stacks[1:]:
+        apply(model, loras)
+    ms = (time.perf_counter() - start) * 1000.0 / (len(stacks) - 1)
+
+    stacks = schedule(1)
+    counter = AllocationCounter()
+    tracemalloc.start()
+    with counter:
+        for loras in stacks[1:]:
+            apply(model, loras)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "ms": ms,
+        "allocs": counter.count / (len(stacks) - 1),
+        "tensor_mib": counter.nbytes / (len(stacks) - 1) / 2**20,
+        "python_peak_kib": peak / 1024,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--loras", type=int, default=10)
+    parser.add_argument("--keys", type=int, default=3000, help="tensors per LoRA")
+    parser.add_argument("--rank", type=int, default=4)
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--applies", type=int, default=6)
+    args = parser.parse_args(argv)
+
+    with AllocationCounter():
+        # the first dispatch mode imports parts of torch, which tracemalloc would count
+        torch.zeros(1) + 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [
+            fakes.write_lora(f"{tmp}/lora_{i}.safetensors", seed=i, rank=args.rank, blocks=args.keys // 2, dim=args.dim)
+            for i in range(args.loras)
+        ]
+        print(f"{args.loras} LoRAs x {args.keys} tensors (rank {args.rank}, dim {args.dim}), per apply:")
+        print(f"{'scenario':<10}{'path':<10}{'ms':>10}{'allocs':>10}{'tensor MiB':>12}{'py peak KiB':>13}")
+        for scenario, make_schedule in (("sweep", sweep_schedule), ("switch", switch_schedule)):
+            for name, make_apply in (("original", original_apply), ("current", current_apply)):
+                r = measure(make_apply, lambda run: make_schedule(paths, args.applies, run))
+                print(
+                    f"{scenario:<10}{name:<10}{r['ms']:>10.2f}{r['allocs']:>10.1f}"
+                    f"{r['tensor_mib']:>12.2f}{r['python_peak_kib']:>13.1f}"
+                )
+        get_state_dict_cache().clear()
+        get_composed_cache().clear()
+
+
+if __name__ == "__main__":
+    main()
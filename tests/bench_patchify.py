@@ -0,0 +1,157 @@
+"""
+Micro-benchmark of the per-step patchify / unpatchify work of ``ComfyFluxWrapper``, on CPU.
+
+Compares the original implementation (``einops.rearrange`` into new tensors, ``torch.cat`` of
+Kontext references, fresh position IDs and slicing copies every step) with the current one
+(reusable token buffer, cached IDs and a single-copy unpatchify). The transformer itself is
+left out: both paths receive the same precomputed model output.
+
+Tensor allocations are counted with a dispatch mode, so views and writes into existing
+buffers are not counted.
+
+Usage::
+
+    python tests/bench_patchify.py [--size 256] [--steps 30] [--batch 1] [--refs 1]
+"""
+
+import argparse
+import time
+
+import fakes
+
+fakes.install()
+
+import torch  # noqa: E402
+from einops import rearrange, repeat  # noqa: E402
+from torch.utils._python_dispatch import TorchDispatchMode  # noqa: E402
+
+from wrappers.flux import ComfyFluxWrapper, _unpatchify  # noqa: E402
+
+PATCH_SIZE = 2
+
+
+class AllocationCounter(TorchDispatchMode):
+    """
+    Count tensors allocated by ATen ops (outputs that alias no input) and their bytes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.nbytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if not func.is_view:
+            outputs = out if isinstance(out, (tuple, list)) else (out,)
+            for ret, value in zip(func._schema.returns, outputs):
+                if ret.alias_info is None and isinstance(value, torch.Tensor):
+                    self.count += 1
+                    self.nbytes += value.untyped_storage().nbytes()
+        return out
+
+
+def _original_process_img(x, index=0, h_offset=0, w_offset=0):
+    bs, c, h, w = x.shape
+    x = fakes.pad_to_patch_size(x, (PATCH_SIZE, PATCH_SIZE))
+    img = rearrange(x, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=PATCH_SIZE, pw=PATCH_SIZE)
+    h_len = (h + (PATCH_SIZE // 2)) // PATCH_SIZE
+    w_len = (w + (PATCH_SIZE // 2)) // PATCH_SIZE
+    h_offset = (h_offset + (PATCH_SIZE // 2)) // PATCH_SIZE
+    w_offset = (w_offset + (PATCH_SIZE // 2)) // PATCH_SIZE
+    img_ids = torch.zeros((h_len, w_len, 3), device=x.device, dtype=x.dtype)
+    img_ids[:, :, 0] = img_ids[:, :, 1] + index
+    img_ids[:, :, 1] = img_ids[:, :, 1] + torch.linspace(
+        h_offset, h_len - 1 + h_offset, steps=h_len, device=x.device, dtype=x.dtype
+    ).unsqueeze(1)
+    img_ids[:, :, 2] = img_ids[:, :, 2] + torch.linspace(
+        w_offset, w_len - 1 + w_offset, steps=w_len, device=x.device, dtype=x.dtype
+    ).unsqueeze(0)
+    return img, repeat(img_ids, "h w c -> b (h w) c", b=bs)
+
+
+def original_step(x, context, ref_latents, model_out):
+    bs, c, h_orig, w_orig = x.shape
+    h_len = (h_orig + (PATCH_SIZE // 2)) // PATCH_SIZE
+    w_len = (w_orig + (PATCH_SIZE // 2)) // PATCH_SIZE
+    img, img_ids = _original_process_img(x)
+    img_tokens = img.shape[1]
+    h = w = 0
+    for ref in ref_latents:
+        h_offset = w_offset = 0
+        if ref.shape[-2] + h > ref.shape[-1] + w:
+            w_offset = w
+        else:
+            h_offset = h
+        kontext, kontext_ids = _original_process_img(ref, index=1, h_offset=h_offset, w_offset=w_offset)
+        img = torch.cat([img, kontext], dim=1)
+        img_ids = torch.cat([img_ids, kontext_ids], dim=1)
+        h = max(h, ref.shape[-2] + h_offset)
+        w = max(w, ref.shape[-1] + w_offset)
+    txt_ids = torch.zeros((bs, context.shape[1], 3), device=x.device, dtype=x.dtype)
+
+    out = model_out[:, :img_tokens]
+    out = rearrange(out, "b (h w) (c ph pw) -> b c (h ph) (w pw)", h=h_len, w=w_len, ph=PATCH_SIZE, pw=PATCH_SIZE)
+    return out[:, :, :h_orig, :w_orig], img_ids, txt_ids
+
+
+def current_step(wrapper, x, context, ref_latents, model_out):
+    bs, c, h_orig, w_orig = x.shape
+    h_len = (h_orig + (PATCH_SIZE // 2)) // PATCH_SIZE
+    w_len = (w_orig + (PATCH_SIZE // 2)) // PATCH_SIZE
+    img, img_ids, img_tokens = wrapper._prepare_tokens(x, ref_latents or None)
+    txt_ids = wrapper._get_txt_ids(bs, context.shape[1], x.device, x.dtype)
+
+    out = _unpatchify(model_out, h_len, w_len, PATCH_SIZE)
+    if out.shape[-2] != h_orig or out.shape[-1] != w_orig:
+        out = out[:, :, :h_orig, :w_orig]
+    return out, img_ids, txt_ids
+
+
+def run(step, steps: int) -> dict:
+    step()  # warm up, as the first step of a run fills the wrapper caches
+    counter = AllocationCounter()
+    start = time.perf_counter()
+    with counter:
+        for _ in range(steps):
+            step()
+    return {
+        "ms": (time.perf_counter() - start) * 1000.0 / steps,
+        "allocs": counter.count / steps,
+        "mib": counter.nbytes / steps / 2**20,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=256, help="latent height and width (256 is a 2048px image)")
+    parser.add_argument("--channels", type=int, default=16)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--refs", type=int, default=1, help="Kontext reference latents")
+    parser.add_argument("--steps", type=int, default=30)
+    args = parser.parse_args(argv)
+
+    x = torch.randn(args.batch, args.channels, args.size, args.size)
+    refs = [torch.randn(args.batch, args.channels, args.size, args.size) for _ in range(args.refs)]
+    context = torch.randn(args.batch, 512, 64)
+    tokens = (args.size // PATCH_SIZE) ** 2 * (1 + args.refs)
+    model_out = torch.randn(args.batch, tokens, args.channels * PATCH_SIZE * PATCH_SIZE)
+
+    wrapper = ComfyFluxWrapper(fakes.FakeFluxTransformer(), config={"patch_size": PATCH_SIZE, "guidance_embed": False})
+    expected = original_step(x, context, refs, model_out)
+    actual = current_step(wrapper, x, context, refs, model_out)
+    for a, b in zip(expected, actual):
+        torch.testing.assert_close(a, b)
+
+    results = {
+        "original": run(lambda: original_step(x, context, refs, model_out), args.steps),
+        "current": run(lambda: current_step(wrapper, x, context, refs, model_out), args.steps),
+    }
+    print(f"latent {args.batch}x{args.channels}x{args.size}x{args.size}, {args.refs} reference(s), per step:")
+    print(f"{'path':<10}{'ms':>10}{'allocs':>10}{'MiB':>10}")
+    for name, r in results.items():
+        print(f"{name:<10}{r['ms']:>10.2f}{r['allocs']:>10.1f}{r['mib']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+try:
+    import torch  # noqa: F401
+except ImportError:
+    # the wrapper and lora_utils need PyTorch
+    collect_ignore_glob = ["test_*.py"]
+else:
+    import fakes
+
+    fakes.install()
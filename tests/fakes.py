@@ -0,0 +1,169 @@
+"""
+Minimal stand-ins for ComfyUI and Nunchaku, so the wrapper and ``lora_utils`` can be imported
+and exercised on CPU without a GPU build of Nunchaku.
+
+Only the names imported by this package are provided. Real modules are always preferred:
+:func:`install` does nothing for a package that can be imported.
+"""
+
+import importlib
+import os
+import sys
+import types
+from contextlib import contextmanager
+
+import torch
+from torch import nn
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _module(name: str, **attrs) -> types.ModuleType:
+    module = sys.modules.get(name)
+    if module is None:
+        module = sys.modules[name] = types.ModuleType(name)
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(_module(parent), child, module)
+    for k, v in attrs.items():
+        setattr(module, k, v)
+    return module
+
+
+def _importable(name: str) -> bool:
+    try:
+        importlib.import_module(name)
+        return True
+    except ImportError:
+        return False
+
+
+def pad_to_patch_size(img, patch_size=(2, 2), padding_mode="circular"):
+    pad = ()
+    for i in range(img.ndim - 2):
+        pad = (0, (patch_size[i] - img.shape[i + 2] % patch_size[i]) % patch_size[i]) + pad
+    return torch.nn.functional.pad(img, pad, mode=padding_mode)
+
+
+class FakeFluxTransformer(nn.Module):
+    """
+    Transformer with the LoRA bookkeeping of Nunchaku's ``NunchakuFluxTransformer2dModel``.
+
+    ``forward`` returns the image tokens unchanged; :attr:`applied` holds the parameters of the
+    last ``update_lora_params`` call (None after ``reset_lora``).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Linear(4, 4)
+        self.comfy_lora_meta_list = []
+        self.comfy_lora_sd_list = []
+        self.applied = None
+        self.updates = 0
+
+    def update_lora_params(self, params):
+        self.applied = None if params is None else dict(params)
+        self.updates += 1
+
+    def reset_lora(self):
+        self.applied = None
+        self.updates += 1
+
+    def set_lora_strength(self, strength):
+        pass
+
+    def forward(self, hidden_states, **kwargs):
+        return types.SimpleNamespace(sample=hidden_states)
+
+
+def compose_lora(loras):
+    """
+    Same combination rules as Nunchaku's ``compose_lora`` for Diffusers-format LoRAs.
+    """
+    parts = {}
+    for sd, strength in loras:
+        for k, v in sd.items():
+            if v.ndim == 1:
+                v = v if ("norm_q" in k or "norm_k" in k) else v * strength
+            elif "lora_B" in k:
+                v = v * strength
+            parts.setdefault(k, []).append(v)
+    composed = {}
+    for k, tensors in parts.items():
+        if tensors[0].ndim == 1:
+            composed[k] = sum(tensors[1:], tensors[0])
+        else:
+            composed[k] = torch.cat(tensors, dim=0 if "lora_A" in k else 1)
+    return composed
+
+
+def load_state_dict_in_safetensors(path, device="cpu"):
+    from safetensors.torch import load_file
+
+    return load_file(path, device=device)
+
+
+@contextmanager
+def cache_context(context):
+    yield context
+
+
+def install():
+    """
+    Register the stand-ins for every missing ComfyUI / Nunchaku module and put the repository
+    on ``sys.path``.
+    """
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    # keep the fingerprint index of the tests in memory
+    os.environ.setdefault("LORA_STACKER_INDEX_DB", "")
+    if not _importable("comfy.ldm.common_dit"):
+        _module("comfy.ldm.common_dit", pad_to_patch_size=pad_to_patch_size)
+    if not _importable("nunchaku"):
+        _module("nunchaku", NunchakuFluxTransformer2dModel=FakeFluxTransformer)
+        _module("nunchaku.caching.fbcache", cache_context=cache_context, create_cache_context=lambda: object())
+        _module("nunchaku.utils", load_state_dict_in_safetensors=load_state_dict_in_safetensors)
+        _module("nunchaku.lora.flux.compose", compose_lora=compose_lora)
+        _module("nunchaku.lora.flux.utils", is_nunchaku_format=lambda sd: False)
+
+
+def write_lora(path, seed: int = 0, rank: int = 2, blocks: int = 2, dim: int = 8) -> str:
+    """
+    Write a small Diffusers-format FLUX LoRA to ``path`` and return ``path``.
+    """
+    from safetensors.torch import save_file
+
+    generator = torch.Generator().manual_seed(seed)
+    sd = {}
+    for i in range(blocks):
+        prefix = f"transformer.transformer_blocks.{i}.attn.to_q"
+        sd[f"{prefix}.lora_A.weight"] = torch.randn(rank, dim, generator=generator)
+        sd[f"{prefix}.lora_B.weight"] = torch.randn(dim, rank, generator=generator)
+    save_file(sd, str(path))
+    return str(path)
+
+
+def nunchaku_wrapper_step(model, loras):
+    """
+    LoRA handling of ComfyUI-nunchaku's own ``ComfyFluxWrapper.forward`` for one step.
+    """
+    if loras == model.comfy_lora_meta_list:
+        return
+    for _ in range(max(0, len(model.comfy_lora_meta_list) - len(loras))):
+        model.comfy_lora_meta_list.pop()
+        model.comfy_lora_sd_list.pop()
+    to_compose = []
+    for i, meta in enumerate(loras):
+        if i >= len(model.comfy_lora_meta_list):
+            model.comfy_lora_meta_list.append(meta)
+            model.comfy_lora_sd_list.append(load_state_dict_in_safetensors(meta[0]))
+        elif model.comfy_lora_meta_list[i] != meta:
+            if meta[0] != model.comfy_lora_meta_list[i][0]:
+                model.comfy_lora_sd_list[i] = load_state_dict_in_safetensors(meta[0])
+            model.comfy_lora_meta_list[i] = meta
+        to_compose.append(({k: v for k, v in model.comfy_lora_sd_list[i].items()}, meta[1]))
+    composed = compose_lora(to_compose)
+    if len(composed) == 0:
+        model.reset_lora()
+    else:
+        model.update_lora_params(composed)
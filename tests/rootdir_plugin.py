@@ -0,0 +1,19 @@
+"""
+pytest plugin collecting the repository root as a plain directory.
+
+The root ``__init__.py`` registers the nodes with a running ComfyUI and cannot be imported
+on its own, so pytest must not set it up as a package.
+"""
+
+import os
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collect_directory(path, parent):
+    if str(path) == REPO_ROOT:
+        return pytest.Dir.from_parent(parent, path=path)
+    return None
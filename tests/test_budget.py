@@ -0,0 +1,93 @@
+import pytest
+import torch
+
+import fakes
+from lora_utils.budget import (
+    DEVICE_ELEMENT_BYTES,
+    RANK_ALIGNMENT,
+    check_stack_budget,
+    plan_stack,
+    truncate_lora_ranks,
+    truncate_stack_ranks,
+)
+
+LAYER = "transformer_blocks_0_attn_to_q"
+
+
+def test_plan_stack(tmp_path):
+    a = fakes.write_lora(tmp_path / "a.safetensors", rank=2, blocks=2, dim=8)
+    b = fakes.write_lora(tmp_path / "b.safetensors", rank=4, blocks=1, dim=8)
+    plan = plan_stack([a, b])
+    assert plan.layer_ranks[LAYER] == (6, 8, 8)
+    assert plan.layer_ranks["transformer_blocks_1_attn_to_q"] == (2, 8, 8)
+    assert plan.max_rank == 6
+    assert plan.device_bytes == 2 * RANK_ALIGNMENT * (8 + 8) * DEVICE_ELEMENT_BYTES
+    assert plan.host_bytes == 3 * 4 * (2 * 2 * 2 * 8 + 2 * 4 * 8)
+    assert plan_stack([a, str(tmp_path / "other.bin")]) is None
+
+
+def _wide_stack(tmp_path):
+    # two layers of rank 64 each: 4 aligned blocks of 16 per layer on the device
+    return [fakes.write_lora(tmp_path / f"{i}.safetensors", seed=i, rank=32, blocks=2, dim=64) for i in range(2)]
+
+
+def test_check_stack_budget_actions(tmp_path, monkeypatch):
+    paths = _wide_stack(tmp_path)
+    full = plan_stack(paths).device_bytes
+    assert check_stack_budget(paths) is None
+
+    monkeypatch.setenv("LORA_STACKER_BUDGET_DEVICE_MB", str(full / 2 / 2**20))
+    monkeypatch.setenv("LORA_STACKER_BUDGET_ACTION", "warn")
+    assert check_stack_budget(paths) is None
+    monkeypatch.setenv("LORA_STACKER_BUDGET_ACTION", "refuse")
+    with pytest.raises(ValueError, match="exceeds the memory budget"):
+        check_stack_budget(paths)
+    monkeypatch.setenv("LORA_STACKER_BUDGET_ACTION", "truncate")
+    assert check_stack_budget(paths) == 32
+
+    monkeypatch.setenv("LORA_STACKER_BUDGET_DEVICE_MB", str(full / 2**20))
+    assert check_stack_budget(paths) is None
+
+
+def test_truncation_is_best_rank_r_approximation():
+    generator = torch.Generator().manual_seed(0)
+    down = torch.randn(12, 40, generator=generator, dtype=torch.float64)
+    up = torch.randn(30, 12, generator=generator, dtype=torch.float64)
+    small_down = torch.randn(2, 40, generator=generator, dtype=torch.float64)
+    sd = {
+        "x.lora_A.weight": down,
+        "x.lora_B.weight": up,
+        "y.lora_down.weight": small_down,
+        "y.lora_up.weight": torch.randn(30, 2, generator=generator, dtype=torch.float64),
+        "y.alpha": torch.tensor(2.0),
+        "z.lora_down.weight": down,
+        "z.lora_up.weight": up,
+        "z.alpha": torch.tensor(12.0, dtype=torch.float64),
+    }
+    result = truncate_lora_ranks(sd, 4)
+
+    assert result["x.lora_A.weight"].shape == (4, 40)
+    assert result["x.lora_B.weight"].shape == (30, 4)
+    product = up @ down
+    approx = result["x.lora_B.weight"] @ result["x.lora_A.weight"]
+    u, s, vh = torch.linalg.svd(product)
+    # factorized in float32; Eckart-Young: no rank-4 matrix is closer to the product
+    torch.testing.assert_close(approx, (u[:, :4] * s[:4]) @ vh[:4], rtol=1e-4, atol=1e-4)
+    assert torch.linalg.norm(product - approx).item() == pytest.approx(s[4:].norm().item(), rel=1e-5)
+    # pairs within the cap are shared, kohya alphas keep the effective scale
+    assert result["y.lora_down.weight"] is small_down
+    assert result["y.alpha"] is sd["y.alpha"]
+    assert result["z.alpha"].item() == pytest.approx(4.0)
+    assert sd["x.lora_A.weight"] is down
+
+
+def test_truncate_stack_ranks_is_cached():
+    generator = torch.Generator().manual_seed(1)
+    sd = {
+        "x.lora_A.weight": torch.randn(8, 16, generator=generator),
+        "x.lora_B.weight": torch.randn(16, 8, generator=generator),
+    }
+    key = (("file", 1, 2, "abc"), 1.0)
+    first = truncate_stack_ranks(key, sd, 4)
+    assert truncate_stack_ranks(key, sd, 4) is first
+    assert truncate_stack_ranks(key, sd, 2)["x.lora_A.weight"].shape == (2, 16)
@@ -0,0 +1,26 @@
+import fakes
+from wrappers.flux import ComfyFluxWrapper
+
+KEY = "transformer.transformer_blocks.0.attn.to_q.lora_A.weight"
+
+
+def test_background_compose_uses_transformer_composer(tmp_path):
+    model = fakes.FakeFluxTransformer()
+    a = fakes.write_lora(tmp_path / "a.safetensors", seed=1)
+    b = fakes.write_lora(tmp_path / "b.safetensors", seed=2)
+
+    first = ComfyFluxWrapper(model, config={"patch_size": 2, "guidance_embed": False})
+    first.loras = [(a, 0.5), (b, 1.0)]
+    first.prefetch_loras()
+    first_lora_a = first._prepared_stack.result()[KEY]
+
+    # strength sweep: only the second slot changes
+    second = ComfyFluxWrapper(model, config={"patch_size": 2, "guidance_embed": False})
+    second.loras = [(a, 0.5), (b, 0.8)]
+    second.prefetch_loras()
+    composed = second._prepared_stack.result()
+
+    composer = model.comfy_lora_composer
+    assert [slot_key[1] for slot_key, _ in composer.slots] == [0.5, 0.8]
+    # the concatenated lora_A matrices are reused, not recomputed by a full compose_lora
+    assert composed[KEY] is first_lora_a
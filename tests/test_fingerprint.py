@@ -0,0 +1,48 @@
+import os
+import shutil
+
+from lora_utils.fingerprint import SAMPLE_BYTES, FingerprintIndex, dedupe_by_content
+
+SIZE = 4 * SAMPLE_BYTES
+# between the head and middle samples of a SIZE-byte file
+UNSAMPLED_OFFSET = SAMPLE_BYTES + SAMPLE_BYTES // 4
+
+
+def _write(path, flip=False, mtime_ns=1_700_000_000_000_000_000):
+    data = bytearray(SIZE)
+    if flip:
+        data[UNSAMPLED_OFFSET] = 1
+    with open(path, "wb") as f:
+        f.write(data)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return str(path)
+
+
+def test_rewrite_outside_samples_changes_fingerprint(tmp_path):
+    index = FingerprintIndex(full_hash_in_background=False)
+    path = _write(tmp_path / "a.safetensors")
+    before = index.lookup(path)
+    _write(path, flip=True, mtime_ns=before.mtime_ns + 1)
+    after = index.lookup(path)
+    assert after.partial_hash == before.partial_hash
+    assert after.fingerprint != before.fingerprint
+
+
+def test_dedupe_requires_matching_full_hash(tmp_path):
+    a = _write(tmp_path / "a.safetensors")
+    b = _write(tmp_path / "b.safetensors", flip=True)
+    copy = str(tmp_path / "copy.safetensors")
+    shutil.copyfile(a, copy)
+    paths = {"a": a, "b": b, "copy": copy, "missing": str(tmp_path / "missing.safetensors")}
+
+    slots = [("a", 1.0), ("b", 0.5), ("copy", 0.8), ("a", 0.3), ("missing", 1.0), ("missing", 1.0)]
+    assert dedupe_by_content(slots, paths.__getitem__) == [("a", 1.0), ("b", 0.5), ("missing", 1.0)]
+
+
+def test_baked_stack_slots_dedupe_by_content(tmp_path):
+    from lora_utils.bake import normalize_stack
+
+    a = _write(tmp_path / "a.safetensors")
+    shutil.copyfile(a, tmp_path / "copy.safetensors")
+    slots = [("None", 1.0), ("a.safetensors", 0.0), ("copy.safetensors", 0.7), ("a.safetensors", 1.0), ("", 1.0)]
+    assert normalize_stack(slots, lambda n: str(tmp_path / n)) == [("copy.safetensors", 0.7)]
@@ -0,0 +1,93 @@
+import json
+import struct
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+import fakes
+from lora_utils.header_index import estimate_composed_bytes, get_header_index, validate_stack
+from lora_utils.safetensors_mmap import read_safetensors_header
+
+
+def _save(path, tensors):
+    save_file(tensors, str(path))
+    return str(path)
+
+
+def _flux_lora(path, in_channels=64):
+    return _save(
+        path,
+        {
+            "transformer.x_embedder.lora_A.weight": torch.zeros(2, in_channels),
+            "transformer.x_embedder.lora_B.weight": torch.zeros(8, 2),
+            "transformer.transformer_blocks.0.attn.to_q.lora_A.weight": torch.zeros(2, 8),
+            "transformer.transformer_blocks.0.attn.to_q.lora_B.weight": torch.zeros(8, 2),
+        },
+    )
+
+
+def test_header_ranks(tmp_path):
+    header = get_header_index().get(_flux_lora(tmp_path / "a.safetensors", in_channels=128))
+    assert header.is_lora and header.is_flux
+    assert header.ranks()["transformer.transformer_blocks.0.attn.to_q"] == (2, 8, 8)
+    assert header.x_embedder_in_channels == 128
+    assert header.nbytes == 4 * (2 * 128 + 8 * 2 + 2 * 8 + 8 * 2)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"\x01\x02\x03",
+        struct.pack("<Q", 1 << 40) + b"{}",
+        struct.pack("<Q", 4) + b"[1]\n",
+        struct.pack("<Q", 5) + b"{abc}",
+    ],
+    ids=["empty", "truncated", "header_past_eof", "not_an_object", "bad_json"],
+)
+def test_unreadable_header(tmp_path, data):
+    path = tmp_path / "broken.safetensors"
+    path.write_bytes(data)
+    with pytest.raises(ValueError):
+        read_safetensors_header(str(path))
+    assert get_header_index().get(str(path)) is None
+    assert validate_stack([str(path)]) == [f"{path}: unreadable safetensors header"]
+    assert estimate_composed_bytes([str(path)]) is None
+
+
+def test_malformed_tensor_entry(tmp_path):
+    body = json.dumps({"w": {"dtype": "F32"}}).encode()
+    path = tmp_path / "entry.safetensors"
+    path.write_bytes(struct.pack("<Q", len(body)) + body)
+    assert validate_stack([str(path)]) == [f"{path}: unreadable safetensors header"]
+
+
+def test_validate_stack(tmp_path):
+    flux = fakes.write_lora(tmp_path / "flux.safetensors")
+    fill = _flux_lora(tmp_path / "fill.safetensors", in_channels=384)
+    regular = _flux_lora(tmp_path / "regular.safetensors", in_channels=64)
+    sd15 = _save(
+        tmp_path / "sd15.safetensors",
+        {
+            "lora_unet_down_blocks_0_attentions_0_proj_in.lora_down.weight": torch.zeros(2, 8),
+            "lora_unet_down_blocks_0_attentions_0_proj_in.lora_up.weight": torch.zeros(8, 2),
+        },
+    )
+    checkpoint = _save(tmp_path / "model.safetensors", {"double_blocks.0.img_attn.qkv.weight": torch.zeros(4, 4)})
+    empty = _save(tmp_path / "empty.safetensors", {})
+
+    assert validate_stack([flux, fill, str(tmp_path / "baked.bin")]) == []
+    # not a low-rank LoRA, e.g. pre-converted: only logged
+    assert validate_stack([flux, checkpoint]) == []
+    assert validate_stack([sd15]) == [f"{sd15}: does not look like a FLUX LoRA (no FLUX transformer block keys)"]
+    assert validate_stack([empty]) == [f"{empty}: contains no tensors"]
+    (problem,) = validate_stack([fill, regular])
+    assert problem.startswith("LoRAs expect different image embedder input channels")
+
+
+def test_estimate_composed_bytes(tmp_path):
+    a = fakes.write_lora(tmp_path / "a.safetensors", rank=2, blocks=2, dim=8)
+    b = fakes.write_lora(tmp_path / "b.safetensors", rank=4, blocks=1, dim=8)
+    assert estimate_composed_bytes([a, b]) == 4 * (2 * 2 * 2 * 8 + 2 * 4 * 8)
+    assert estimate_composed_bytes([a, str(tmp_path / "missing.safetensors")]) is None
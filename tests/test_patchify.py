@@ -0,0 +1,37 @@
+import torch
+
+import fakes
+from wrappers.flux import ComfyFluxWrapper, _patchify_into, _unpatchify
+
+
+def _reference_unpatchify(tokens, h_len, w_len, p):
+    b, _, d = tokens.shape
+    c = d // (p * p)
+    x = tokens[:, : h_len * w_len].reshape(b, h_len, w_len, c, p, p).permute(0, 3, 1, 4, 2, 5)
+    return x.reshape(b, c, h_len * p, w_len * p)
+
+
+def test_patchify_roundtrip():
+    x = torch.randn(2, 16, 8, 12)
+    tokens = torch.empty(2, 4 * 6, 64)
+    _patchify_into(x, tokens, 2)
+    torch.testing.assert_close(_unpatchify(tokens, 4, 6, 2), x)
+
+
+def test_unpatchify_accepts_non_contiguous_output():
+    # e.g. a customized_forward returning a transposed or sliced view
+    tokens = torch.randn(2, 64, 4 * 6).transpose(1, 2)
+    assert not tokens.is_contiguous()
+    torch.testing.assert_close(_unpatchify(tokens, 4, 6, 2), _reference_unpatchify(tokens, 4, 6, 2))
+
+
+def test_prepare_tokens_matches_process_img():
+    wrapper = ComfyFluxWrapper(fakes.FakeFluxTransformer(), config={"patch_size": 2, "guidance_embed": False})
+    x = torch.randn(1, 16, 7, 9)
+    ref = torch.randn(1, 16, 6, 6)
+    img, img_ids, img_tokens = wrapper._prepare_tokens(x, [ref])
+    expected_img, expected_ids = wrapper.process_img(x)
+    kontext, kontext_ids = wrapper.process_img(ref, index=1)
+    assert img_tokens == expected_img.shape[1]
+    torch.testing.assert_close(img, torch.cat([expected_img, kontext], dim=1))
+    torch.testing.assert_close(img_ids, torch.cat([expected_ids, kontext_ids], dim=1))
@@ -0,0 +1,32 @@
+import torch
+from safetensors.torch import load_file, save_file
+
+from lora_utils.safetensors_mmap import load_safetensors_mmap
+
+
+def test_mmap_matches_safetensors(tmp_path):
+    path = str(tmp_path / "a.safetensors")
+    # the int8 tensor shifts the float tensors after it off their element alignment
+    save_file(
+        {
+            "a": torch.randn(3, 5),
+            "b": torch.arange(3, dtype=torch.int8),
+            "c": torch.randn(4, dtype=torch.float16),
+            "empty": torch.zeros(0, 2),
+        },
+        path,
+    )
+    expected = load_file(path)
+    loaded = load_safetensors_mmap(path)
+    assert loaded.keys() == expected.keys()
+    for key, tensor in expected.items():
+        assert loaded[key].dtype == tensor.dtype and torch.equal(loaded[key], tensor)
+
+
+def test_unmapped_dtype_is_copied(tmp_path):
+    path = str(tmp_path / "u16.safetensors")
+    save_file({"a": torch.randn(2, 3), "u": torch.tensor([1, 2, 300]).to(torch.uint16)}, path)
+    loaded = load_safetensors_mmap(path)
+    assert loaded["u"].dtype == torch.uint16
+    assert loaded["u"].tolist() == [1, 2, 300]
+    assert torch.equal(loaded["a"], load_file(path)["a"])
@@ -0,0 +1,70 @@
+import torch
+
+import fakes
+from wrappers.flux import ComfyFluxWrapper
+
+
+def _wrapper(model, loras=()):
+    wrapper = ComfyFluxWrapper(model, config={"patch_size": 2, "guidance_embed": False})
+    wrapper.loras = list(loras)
+    return wrapper
+
+
+def _step(wrapper):
+    x = torch.randn(1, 16, 4, 4)
+    wrapper(x, torch.ones(1), torch.randn(1, 2, 8), torch.randn(1, 8), guidance=None)
+
+
+def test_stack_reapplied_after_bare_comfyui_nunchaku_wrapper(tmp_path):
+    # base model to one sampler, stacked model to another, sharing the transformer
+    model = fakes.FakeFluxTransformer()
+    stacked = _wrapper(model, [(fakes.write_lora(tmp_path / "a.safetensors"), 0.7)])
+
+    _step(stacked)
+    assert model.applied is not None
+    fakes.nunchaku_wrapper_step(model, [])
+    assert model.applied is None
+    # reapplied from the composed cache this time
+    _step(stacked)
+    assert model.applied is not None
+    assert model.comfy_lora_meta_list == stacked.loras
+    fakes.nunchaku_wrapper_step(model, [])
+    assert model.applied is None
+
+
+def test_cache_hit_keeps_slot_lists(tmp_path):
+    model = fakes.FakeFluxTransformer()
+    a = [(fakes.write_lora(tmp_path / "a.safetensors", seed=1), 0.7)]
+    b = [(fakes.write_lora(tmp_path / "b.safetensors", seed=2), 0.5)]
+    stacked_a = _wrapper(model, a)
+
+    _step(stacked_a)
+    _step(_wrapper(model, b))
+    # composed cache hit: the slot file is not read again
+    _step(stacked_a)
+    assert model.comfy_lora_meta_list == a
+    assert not model.comfy_lora_sd_list[0].loaded
+    expected = dict(model.applied)
+
+    # ComfyUI-nunchaku's wrapper only changes the strength, reusing the slot's state dict
+    fakes.nunchaku_wrapper_step(model, [(a[0][0], 1.0)])
+    fakes.nunchaku_wrapper_step(model, a)
+    assert model.applied.keys() == expected.keys()
+    for k, v in expected.items():
+        torch.testing.assert_close(model.applied[k], v)
+
+
+def test_loras_list_mutation_updates_stack(tmp_path):
+    model = fakes.FakeFluxTransformer()
+    wrapper = _wrapper(model)
+    path = fakes.write_lora(tmp_path / "a.safetensors")
+
+    wrapper.loras.append((path, 0.7))
+    assert wrapper.loras == [(path, 0.7)]
+    assert len(wrapper.lora_stack) == 1
+    wrapper.loras[0] = (path, 0.5)
+    assert wrapper.lora_stack.strengths == (0.5,)
+
+    _step(wrapper)
+    assert model.applied is not None
+    assert model.comfy_lora_meta_list == [(path, 0.5)]
@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+import fakes
+from wrappers.flux import ComfyFluxWrapper
+
+
+@pytest.fixture
+def item_calls(monkeypatch):
+    calls = []
+    original = torch.Tensor.item
+
+    def item(self):
+        calls.append(self)
+        return original(self)
+
+    monkeypatch.setattr(torch.Tensor, "item", item)
+    return calls
+
+
+def _wrapper():
+    return ComfyFluxWrapper(fakes.FakeFluxTransformer(), config={"patch_size": 2, "guidance_embed": False})
+
+
+def _step(wrapper, timestep, transformer_options):
+    x = torch.randn(2, 16, 8, 8)
+    context = torch.randn(2, 4, 8)
+    y = torch.randn(2, 8)
+    return wrapper(x, timestep, context, y, guidance=None, transformer_options=transformer_options)
+
+
+def test_no_item_when_caching_disabled(item_calls):
+    wrapper = _wrapper()
+    for t in (1.0, 0.5, 0.25):
+        out = _step(wrapper, torch.full((2,), t), {})
+        assert out.shape == (2, 16, 8, 8)
+    assert item_calls == []
+
+
+def test_no_item_with_sample_sigmas(item_calls):
+    wrapper = _wrapper()
+    wrapper.model.residual_diff_threshold_multi = 0.1
+    sigmas = torch.tensor([1.0, 0.5, 0.25, 0.0])
+    for t in sigmas[:-1]:
+        _step(wrapper, t.expand(2), {"sample_sigmas": sigmas, "cond_or_uncond": [0, 1]})
+    assert item_calls == []
+    assert wrapper.fbcache_policy.stats()["reuses"] == 2
+
+
+def test_timestep_read_only_without_sample_sigmas(item_calls):
+    wrapper = _wrapper()
+    wrapper.model.residual_diff_threshold_multi = 0.1
+    _step(wrapper, torch.full((2,), 1.0), {})
+    assert len(item_calls) == 1
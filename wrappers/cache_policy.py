@@ -0,0 +1,166 @@
+"""
+This module decides when :class:`~wrappers.flux.ComfyFluxWrapper` may reuse its first-block
+cache context across sampling steps.
+
+The first-block cache compares the first transformer block's residual against the one stored
+in its cache context, so a context must only be shared by calls that belong to the same
+sampling run, the same batch composition and the same LoRA weights. Instead of inferring run
+boundaries from the timestep sequence (which breaks on restart samplers and on CFG batches
+that call the model twice per step), :class:`FirstBlockCachePolicy` keys the context on:
+
+- the sampling run, identified by the ``sample_sigmas`` tensor ComfyUI places in
+  ``transformer_options`` (the timestep heuristic is only used when it is missing),
+- the batch composition (``transformer_options["cond_or_uncond"]`` and batch size),
+- the applied LoRA stack.
+
+The mode is configured with the ``LORA_STACKER_FBCACHE_MODE`` environment variable:
+
+``per-run`` (default)
+    One context per run; it is replaced when the batch composition changes.
+``per-cond``
+    One context per batch composition within a run, so cond and uncond calls that alternate
+    within a step each keep their own context.
+``disabled``
+    A fresh context for every call, i.e. no reuse across steps.
+"""
+
+import logging
+import os
+from typing import Hashable
+
+import torch
+
+from nunchaku.caching.fbcache import create_cache_context
+
+from lora_utils.metrics import get_registry
+
+logger = logging.getLogger(__name__)
+
+FBCACHE_MODES = ("per-run", "per-cond", "disabled")
+DEFAULT_FBCACHE_MODE = "per-run"
+
+# reasons that start a new sampling run and drop every context
+_RUN_RESETS = ("disabled", "lora_changed", "new_run")
+
+
+def _host_timestep(timestep: torch.Tensor | float) -> float:
+    # reading a device tensor synchronizes the stream, so this only runs for the fallback heuristic
+    if isinstance(timestep, torch.Tensor):
+        return (timestep if timestep.numel() == 1 else timestep.flatten()[0]).item()
+    return timestep
+
+
+class FirstBlockCachePolicy:
+    """
+    Hand out first-block cache contexts for the calls of a single wrapper.
+
+    Parameters
+    ----------
+    mode : str, optional
+        One of :data:`FBCACHE_MODES`. Defaults to ``LORA_STACKER_FBCACHE_MODE``.
+
+    Attributes
+    ----------
+    steps : int
+        Number of contexts handed out.
+    reuses : int
+        Number of those that reused an existing context.
+    """
+
+    def __init__(self, mode: str | None = None):
+        if mode is None:
+            mode = os.getenv("LORA_STACKER_FBCACHE_MODE", DEFAULT_FBCACHE_MODE)
+        mode = mode.lower()
+        if mode not in FBCACHE_MODES:
+            raise ValueError(f"Unknown first-block cache mode {mode!r}, expected one of {FBCACHE_MODES}")
+        self.mode = mode
+        self.steps = 0
+        self.reuses = 0
+        self._contexts = {}  # slot -> cache context
+        self._prev_timesteps = {}  # slot -> timestep of its last call, for the fallback heuristic
+        self._run_sigmas = None
+        self._lora_signature = None
+        self._last_cond_key = None
+
+    def context_for(
+        self, transformer_options: dict, timestep: torch.Tensor | float, lora_signature: Hashable, batch_size: int
+    ):
+        """
+        Return the cache context to run the current call in.
+
+        Parameters
+        ----------
+        transformer_options : dict
+            ComfyUI transformer options of the call.
+        timestep : torch.Tensor or float
+            Timestep of the call. It is only read (forcing a device synchronization) when
+            ``sample_sigmas`` is not available.
+        lora_signature : Hashable
+            Identity of the LoRA stack applied to the model.
+        batch_size : int
+            Batch size of the call.
+        """
+        cond_key = (tuple(transformer_options.get("cond_or_uncond") or ()), batch_size)
+        slot = cond_key if self.mode == "per-cond" else None
+        sigmas = transformer_options.get("sample_sigmas")
+        host_timestep = None if sigmas is not None or self.mode == "disabled" else _host_timestep(timestep)
+
+        if self.mode == "disabled":
+            reason = "disabled"
+        elif lora_signature != self._lora_signature:
+            reason = "lora_changed"
+        elif sigmas is not None and sigmas is not self._run_sigmas:
+            reason = "new_run"
+        elif sigmas is None and not self._prev_timesteps.get(slot, float("-inf")) >= host_timestep + 1e-5:
+            # no run identity: a non-decreasing timestep is taken as the start of a new run
+            reason = "timestep"
+        elif slot not in self._contexts:
+            reason = "new_cond"
+        elif slot is None and cond_key != self._last_cond_key:
+            reason = "batch_changed"
+        else:
+            reason = None
+
+        if reason in _RUN_RESETS:
+            self._contexts.clear()
+            self._prev_timesteps.clear()
+        # holding the sigmas keeps their identity from being reused by another run
+        self._run_sigmas = sigmas
+        self._lora_signature = lora_signature
+        if host_timestep is not None:
+            self._prev_timesteps[slot] = host_timestep
+        self._last_cond_key = cond_key
+
+        registry = get_registry()
+        self.steps += 1
+        registry.inc("fbcache_steps_total")
+        if reason is None:
+            self.reuses += 1
+            registry.inc("fbcache_context_reuses_total")
+            return self._contexts[slot]
+
+        logger.debug(f"New first-block cache context ({reason})")
+        registry.inc("fbcache_context_resets_total", reason=reason)
+        context = self._contexts[slot] = create_cache_context()
+        return context
+
+    def reset(self):
+        """
+        Drop all contexts; the next call starts a new run.
+        """
+        self._contexts.clear()
+        self._prev_timesteps.clear()
+        self._run_sigmas = None
+        self._lora_signature = None
+        self._last_cond_key = None
+
+    def stats(self) -> dict:
+        """
+        Return the mode, call count and context reuse rate.
+        """
+        return {
+            "mode": self.mode,
+            "steps": self.steps,
+            "reuses": self.reuses,
+            "reuse_rate": self.reuses / self.steps if self.steps else 0.0,
+        }
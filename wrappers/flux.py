@@ -4,18 +4,182 @@ enabling integration with ComfyUI forward,
 LoRA composition, and advanced caching strategies.
 """
 
+import logging
+import time
+from collections import OrderedDict
 from typing import Callable
 
 import torch
 from comfy.ldm.common_dit import pad_to_patch_size
-from einops import rearrange, repeat
 from torch import nn
 
 from nunchaku import NunchakuFluxTransformer2dModel
-from nunchaku.caching.fbcache import cache_context, create_cache_context
-from nunchaku.lora.flux.compose import compose_lora
+from nunchaku.caching.fbcache import cache_context
 from nunchaku.utils import load_state_dict_in_safetensors
 
+from lora_utils.applied import mark_applied
+from lora_utils.budget import truncate_stack_ranks
+from lora_utils.cache import LazyLoraStateDict
+from lora_utils.compose import IncrementalComposer, compose_lora_stack, compose_stack_async, lookup_composed
+from lora_utils.metrics import get_registry, timed
+from lora_utils.prefetch import load_loras_parallel, prefetch_lora
+from lora_utils.staging import get_staging_pool, upload_async
+from lora_utils.stack import EMPTY_STACK, LoraStackDescriptor
+from wrappers.cache_policy import FirstBlockCachePolicy
+
+logger = logging.getLogger(__name__)
+
+# position ID tensors kept per wrapper; one entry per (shape, offsets, device, dtype)
+_IDS_CACHE_SIZE = 16
+
+# reassigning any of these attributes invalidates the wrapper's call plan
+_CALL_PLAN_ATTRS = frozenset(("customized_forward", "forward_kwargs", "config"))
+
+
+class _LoraList(list):
+    """
+    ``(path, strength)`` list returned by :attr:`ComfyFluxWrapper.loras`.
+
+    Every in-place change rebuilds the wrapper's :class:`~lora_utils.stack.LoraStackDescriptor`,
+    so ``wrapper.loras.append(...)`` keeps working as with the plain list of earlier versions.
+    """
+
+    def __init__(self, wrapper, loras):
+        super().__init__(loras)
+        self._wrapper = wrapper
+
+    def _sync(self):
+        self._wrapper.lora_stack = LoraStackDescriptor.from_loras(self)
+
+
+def _synced(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        result = method(self, *args)
+        self._sync()
+        return result
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in (
+    "append",
+    "extend",
+    "insert",
+    "remove",
+    "pop",
+    "clear",
+    "sort",
+    "reverse",
+    "__setitem__",
+    "__delitem__",
+    "__iadd__",
+    "__imul__",
+):
+    setattr(_LoraList, _name, _synced(_name))
+del _name
+
+
+def _detach_pulid_ca(model: NunchakuFluxTransformer2dModel) -> list[tuple[nn.Module, nn.Module]]:
+    """
+    Temporarily remove the PuLID cross-attention modules from the first transformer blocks.
+
+    Parameters
+    ----------
+    model : :class:`~nunchaku.models.transformers.transformer_flux.NunchakuFluxTransformer2dModel`
+        The transformer about to receive new LoRA parameters.
+
+    Returns
+    -------
+    list[tuple[nn.Module, nn.Module]]
+        ``(block, pulid_ca)`` pairs to pass to :func:`_reattach_pulid_ca`.
+    """
+    detached = []
+    for blocks_name in ("transformer_blocks", "_original_blocks"):
+        blocks = getattr(model, blocks_name, None)
+        if blocks is None or len(blocks) == 0:
+            continue
+        block = blocks[0]
+        pulid_ca = getattr(block, "pulid_ca", None)
+        if pulid_ca is not None:
+            block.pulid_ca = None
+            detached.append((block, pulid_ca))
+    return detached
+
+
+def _reattach_pulid_ca(detached: list[tuple[nn.Module, nn.Module]]):
+    """
+    Put back the modules removed by :func:`_detach_pulid_ca`, weights untouched.
+    """
+    for block, pulid_ca in detached:
+        block.pulid_ca = pulid_ca
+
+
+def _patchify_into(x: torch.Tensor, out: torch.Tensor, patch_size: int) -> torch.Tensor:
+    """
+    Write ``b c (h ph) (w pw) -> b (h w) (c ph pw)`` of ``x`` into ``out`` without a temporary.
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Padded image tensor of shape (batch, channels, height, width).
+    out : torch.Tensor
+        Destination of shape (batch, num_patches, patch_dim). It may be a slice of a larger
+        token buffer.
+
+    Returns
+    -------
+    torch.Tensor
+        ``out``.
+    """
+    b, c, hp, wp = x.shape
+    h, w = hp // patch_size, wp // patch_size
+    src = x.reshape(b, c, h, patch_size, w, patch_size).permute(0, 2, 4, 1, 3, 5)
+    out.view(b, h, w, c, patch_size, patch_size).copy_(src)
+    return out
+
+
+def _unpatchify(
+    tokens: torch.Tensor, h_len: int, w_len: int, patch_size: int, out: torch.Tensor | None = None
+) -> torch.Tensor:
+    """
+    Write ``b (h w) (c ph pw) -> b c (h ph) (w pw)`` of the first ``h_len * w_len`` tokens.
+
+    Parameters
+    ----------
+    tokens : torch.Tensor
+        Model output of shape (batch, num_tokens, patch_dim); extra (reference) tokens are ignored.
+    out : torch.Tensor, optional
+        Destination of shape (batch, channels, h_len * patch_size, w_len * patch_size).
+        Allocated when not given.
+
+    Returns
+    -------
+    torch.Tensor
+        ``out``.
+    """
+    b, _, patch_dim = tokens.shape
+    c = patch_dim // (patch_size * patch_size)
+    # reshape: the output of a customized_forward may be non-contiguous
+    src = tokens[:, : h_len * w_len].reshape(b, h_len, w_len, c, patch_size, patch_size).permute(0, 3, 1, 4, 2, 5)
+    if out is None:
+        out = torch.empty((b, c, h_len * patch_size, w_len * patch_size), device=tokens.device, dtype=tokens.dtype)
+    out.view(b, c, h_len, patch_size, w_len, patch_size).copy_(src)
+    return out
+
+
+def _tensor_version(t: torch.Tensor):
+    """
+    Return the in-place modification counter of ``t``, or None for inference tensors
+    (created under ``torch.inference_mode``), which do not track it.
+    """
+    try:
+        return t._version
+    except RuntimeError:
+        return None
+
 
 class ComfyFluxWrapper(nn.Module):
     """
@@ -43,14 +207,25 @@ class ComfyFluxWrapper(nn.Module):
         Data type of the model parameters.
     config : dict
         Model configuration.
+    lora_stack : :class:`~lora_utils.stack.LoraStackDescriptor`
+        LoRA stack to apply, set by the stacker nodes.
     loras : list
-        List of LoRA metadata for composition.
+        ``(path, strength)`` pairs of :attr:`lora_stack`. Assigning or modifying the list
+        rebuilds the descriptor.
+    lora_rank_cap : int or None
+        Maximum composed rank per layer, set by the stacker nodes when the stack exceeds the
+        memory budget (see :mod:`lora_utils.budget`). None applies the stack unchanged.
     pulid_pipeline : :class:`~nunchaku.pipeline.pipeline_flux_pulid.PuLIDPipeline` or None
         Pulid pipeline if provided.
     customized_forward : Callable or None
         Custom forward function if provided.
     forward_kwargs : dict
         Additional arguments for the forward pass.
+    fbcache_policy : :class:`~wrappers.cache_policy.FirstBlockCachePolicy`
+        Decides when the first-block cache context is reused across steps.
+    last_lora_timings : dict
+        Timing record (milliseconds) of the last LoRA recomposition: ``disk_load_ms``,
+        ``compose_ms``, ``update_lora_params_ms``, ``pulid_restore_ms`` and ``forward_ms``.
     """
 
     def __init__(
@@ -70,14 +245,56 @@ class ComfyFluxWrapper(nn.Module):
             # Model has no parameters, use default dtype
             self.dtype = torch.float32
         self.config = config
-        self.loras = []
+        self.lora_stack = EMPTY_STACK
+        self.lora_rank_cap = None
 
         self.pulid_pipeline = pulid_pipeline
         self.customized_forward = customized_forward
         self.forward_kwargs = {} if forward_kwargs is None else forward_kwargs
 
-        self._prev_timestep = None  # for first-block cache
-        self._cache_context = None
+        self.last_lora_timings = {}
+        self._prepared_stack = None  # background composition started by prefetch_loras
+        self._ids_cache = OrderedDict()
+        self._ref_cache = None  # packed Kontext reference latents of the current run
+        self._token_buffer = None  # reusable [image tokens | reference tokens] model input
+        self._token_buffer_refs = None  # packed reference tokens currently held by the buffer
+
+        self.fbcache_policy = FirstBlockCachePolicy()
+
+    def prefetch_loras(self):
+        """
+        Start reading the LoRA files in :attr:`loras` in the background.
+
+        Called by the stacker nodes right after setting :attr:`loras`, so the files are
+        resident by the time :meth:`forward` composes them. The stack is also composed in the
+        background with the transformer's incremental composer, overlapping with text encoding.
+        """
+        for path in self.lora_stack.paths:
+            prefetch_lora(path, load_state_dict_in_safetensors, "nunchaku")
+        self._prepared_stack = compose_stack_async(
+            self.lora_stack, load_state_dict_in_safetensors, "nunchaku", self._get_composer(self.model)
+        )
+
+    @property
+    def loras(self) -> list:
+        return _LoraList(self, self.lora_stack)
+
+    @loras.setter
+    def loras(self, loras):
+        self.lora_stack = LoraStackDescriptor.from_loras(loras)
+
+    def _lora_stack_applied(self, model) -> bool:
+        """
+        Return True if :attr:`lora_stack` is the stack currently applied to ``model``.
+        """
+        applied = getattr(model, "comfy_lora_stack", None)
+        if applied is not None and applied is not self.lora_stack and applied != self.lora_stack:
+            return False
+        # The descriptor also catches files replaced in place, but only this wrapper records it.
+        # Every wrapper sharing the transformer, including ComfyUI-nunchaku's own, keeps the meta
+        # list equal to the applied stack, so it has the final say.
+        meta_list = model.comfy_lora_meta_list
+        return len(meta_list) == len(self.lora_stack) and all(a == b for a, b in zip(self.lora_stack, meta_list))
 
     def process_img(self, x, index=0, h_offset=0, w_offset=0):
         """
@@ -101,28 +318,373 @@ class ComfyFluxWrapper(nn.Module):
         img : torch.Tensor
             Rearranged image tensor of shape (batch, num_patches, patch_dim).
         img_ids : torch.Tensor
-            Image ID tensor of shape (batch, num_patches, 3).
+            Image ID tensor of shape (batch, num_patches, 3). It is a cached, read-only
+            view expanded over the batch dimension.
         """
         bs, c, h, w = x.shape
         patch_size = self.config.get("patch_size", 2)
         x = pad_to_patch_size(x, (patch_size, patch_size))
 
-        img = rearrange(x, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=patch_size, pw=patch_size)
         h_len = (h + (patch_size // 2)) // patch_size
         w_len = (w + (patch_size // 2)) // patch_size
+        img = torch.empty((bs, h_len * w_len, c * patch_size * patch_size), device=x.device, dtype=x.dtype)
+        _patchify_into(x, img, patch_size)
+
+        return img, self._img_ids(bs, h_len, w_len, index, h_offset, w_offset, x.device, x.dtype)
 
+    def _img_ids(self, bs, h_len, w_len, index, h_offset, w_offset, device, dtype):
+        patch_size = self.config.get("patch_size", 2)
         h_offset = (h_offset + (patch_size // 2)) // patch_size
         w_offset = (w_offset + (patch_size // 2)) // patch_size
 
-        img_ids = torch.zeros((h_len, w_len, 3), device=x.device, dtype=x.dtype)
+        img_ids = self._cached_ids(
+            ("img", h_len, w_len, index, h_offset, w_offset, device, dtype),
+            lambda: self._build_img_ids(h_len, w_len, index, h_offset, w_offset, device, dtype),
+        )
+        return img_ids.unsqueeze(0).expand(bs, -1, -1)
+
+    @staticmethod
+    def _build_img_ids(h_len, w_len, index, h_offset, w_offset, device, dtype):
+        img_ids = torch.zeros((h_len, w_len, 3), device=device, dtype=dtype)
         img_ids[:, :, 0] = img_ids[:, :, 1] + index
         img_ids[:, :, 1] = img_ids[:, :, 1] + torch.linspace(
-            h_offset, h_len - 1 + h_offset, steps=h_len, device=x.device, dtype=x.dtype
+            h_offset, h_len - 1 + h_offset, steps=h_len, device=device, dtype=dtype
         ).unsqueeze(1)
         img_ids[:, :, 2] = img_ids[:, :, 2] + torch.linspace(
-            w_offset, w_len - 1 + w_offset, steps=w_len, device=x.device, dtype=x.dtype
+            w_offset, w_len - 1 + w_offset, steps=w_len, device=device, dtype=dtype
         ).unsqueeze(0)
-        return img, repeat(img_ids, "h w c -> b (h w) c", b=bs)
+        return img_ids.reshape(h_len * w_len, 3)
+
+    def _cached_ids(self, key, build):
+        """
+        Return the position ID tensor for ``key``, building it with ``build`` on first use.
+
+        Latent size, offsets and context length are constant across the steps of a job, so
+        each job builds its IDs once. At most ``_IDS_CACHE_SIZE`` entries are kept.
+        """
+        ids = self._ids_cache.get(key)
+        if ids is None:
+            ids = build()
+            self._ids_cache[key] = ids
+            if len(self._ids_cache) > _IDS_CACHE_SIZE:
+                self._ids_cache.popitem(last=False)
+        else:
+            self._ids_cache.move_to_end(key)
+        return ids
+
+    def _pack_ref_latents(self, ref_latents):
+        """
+        Patchify Kontext reference latents, reusing the result of the previous step.
+
+        Reference latents do not change during a sampling run, so the packed tokens are cached
+        by tensor identity, version and shape and only rebuilt when a reference changes.
+
+        Returns
+        -------
+        ref_img : torch.Tensor
+            Packed reference tokens of shape (batch, ref_tokens, patch_dim).
+        ref_ids : torch.Tensor
+            Reference position IDs of shape (ref_tokens, 3).
+        shape_key : tuple
+            Shapes, devices and dtypes of the references; the IDs only depend on these.
+        """
+        refs = tuple(ref_latents)
+        shape_key = tuple((tuple(ref.shape), ref.device, ref.dtype) for ref in refs)
+        versions = tuple(_tensor_version(ref) for ref in refs)
+        cached = self._ref_cache
+        if (
+            cached is not None
+            and len(cached[0]) == len(refs)
+            and all(a is b for a, b in zip(cached[0], refs))
+            and cached[1] == (shape_key, versions)
+        ):
+            return cached[2], cached[3], shape_key
+
+        tokens = []
+        ids = []
+        h = 0
+        w = 0
+        for ref in refs:
+            h_offset = 0
+            w_offset = 0
+            if ref.shape[-2] + h > ref.shape[-1] + w:
+                w_offset = w
+            else:
+                h_offset = h
+
+            kontext, kontext_ids = self.process_img(ref, index=1, h_offset=h_offset, w_offset=w_offset)
+            tokens.append(kontext)
+            ids.append(kontext_ids[0])
+            h = max(h, ref.shape[-2] + h_offset)
+            w = max(w, ref.shape[-1] + w_offset)
+
+        ref_img = tokens[0] if len(tokens) == 1 else torch.cat(tokens, dim=1)
+        ref_ids = ids[0] if len(ids) == 1 else torch.cat(ids, dim=0)
+        # holding the references keeps their identity stable while the entry is alive
+        self._ref_cache = (refs, (shape_key, versions), ref_img, ref_ids)
+        return ref_img, ref_ids, shape_key
+
+    def _prepare_tokens(self, x, ref_latents=None):
+        """
+        Patchify the latent (and Kontext reference latents) into the reusable token buffer.
+
+        The buffer holds ``[image tokens | reference tokens]`` and is kept across sampling
+        steps: each step only rewrites the image tokens in place, and the cached reference
+        tokens are copied in once per run.
+
+        Parameters
+        ----------
+        x : torch.Tensor
+            Input latent of shape (batch, channels, height, width).
+        ref_latents : list[torch.Tensor], optional
+            Kontext reference latents.
+
+        Returns
+        -------
+        img : torch.Tensor
+            Token buffer of shape (batch, num_tokens, patch_dim). Only valid until the next call.
+        img_ids : torch.Tensor
+            Position IDs of shape (batch, num_tokens, 3).
+        img_tokens : int
+            Number of image tokens at the start of the sequence.
+        """
+        bs, c, h, w = x.shape
+        patch_size = self.config.get("patch_size", 2)
+        h_len = (h + (patch_size // 2)) // patch_size
+        w_len = (w + (patch_size // 2)) // patch_size
+        img_tokens = h_len * w_len
+        patch_dim = c * patch_size * patch_size
+        img_ids = self._img_ids(bs, h_len, w_len, 0, 0, 0, x.device, x.dtype)
+
+        ref_img = None
+        dtype = x.dtype
+        num_tokens = img_tokens
+        if ref_latents is not None and len(ref_latents) > 0:
+            ref_img, ref_ids, shape_key = self._pack_ref_latents(ref_latents)
+            dtype = torch.promote_types(x.dtype, ref_img.dtype)
+            num_tokens += ref_img.shape[1]
+            base_ids = img_ids[0]
+            joint_ids = self._cached_ids(
+                ("kontext", (h, w), x.device, x.dtype, shape_key),
+                lambda: torch.cat([base_ids, ref_ids], dim=0),
+            )
+            img_ids = joint_ids.unsqueeze(0).expand(bs, -1, -1)
+
+        buf = self._token_buffer
+        if buf is None or buf.shape != (bs, num_tokens, patch_dim) or buf.device != x.device or buf.dtype != dtype:
+            buf = self._token_buffer = torch.empty((bs, num_tokens, patch_dim), device=x.device, dtype=dtype)
+            self._token_buffer_refs = None
+
+        _patchify_into(pad_to_patch_size(x, (patch_size, patch_size)), buf[:, :img_tokens], patch_size)
+        if ref_img is not None and self._token_buffer_refs is not ref_img:
+            buf[:, img_tokens:] = ref_img
+            self._token_buffer_refs = ref_img
+        return buf, img_ids, img_tokens
+
+    def _get_txt_ids(self, bs, txt_len, device, dtype):
+        """
+        Return the (all-zero) text position IDs of shape (batch, txt_len, 3) as a cached,
+        read-only view expanded over the batch dimension.
+        """
+        txt_ids = self._cached_ids(
+            ("txt", txt_len, device, dtype), lambda: torch.zeros((txt_len, 3), device=device, dtype=dtype)
+        )
+        return txt_ids.unsqueeze(0).expand(bs, -1, -1)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in _CALL_PLAN_ATTRS:
+            # nodes such as PuLID reassign these on an existing wrapper
+            self.__dict__["_call_plan"] = None
+
+    def _get_call_plan(self):
+        """
+        Return the function running the transformer, built once per configuration.
+
+        The plan binds the branches that only depend on :attr:`customized_forward`,
+        :attr:`forward_kwargs` and ``config["guidance_embed"]``, so a sampling step does not
+        re-evaluate them. It is rebuilt after any of these attributes is reassigned.
+        """
+        plan = self.__dict__.get("_call_plan")
+        if plan is not None:
+            return plan
+
+        use_guidance = bool(self.config["guidance_embed"])
+        customized_forward = self.customized_forward
+        forward_kwargs = self.forward_kwargs
+
+        if customized_forward is None:
+
+            def plan(model, guidance, **inputs):
+                return model(guidance=guidance if use_guidance else None, **inputs).sample
+
+        else:
+
+            def plan(model, guidance, **inputs):
+                return customized_forward(
+                    model, guidance=guidance if use_guidance else None, **inputs, **forward_kwargs
+                ).sample
+
+        self.__dict__["_call_plan"] = plan
+        return plan
+
+    @staticmethod
+    def _get_composer(model) -> IncrementalComposer:
+        """
+        Return the incremental composer of ``model``, creating it on first use.
+        """
+        composer = getattr(model, "comfy_lora_composer", None)
+        if composer is None:
+            composer = model.comfy_lora_composer = IncrementalComposer()
+        return composer
+
+    @staticmethod
+    def _sync_slot_lists(model, stack):
+        """
+        Align ``model.comfy_lora_meta_list`` and ``comfy_lora_sd_list`` with ``stack`` without
+        reading any file.
+
+        The meta list always describes the applied stack, since every wrapper sharing the
+        transformer compares against it. Slots whose file changed get a
+        :class:`~lora_utils.cache.LazyLoraStateDict`, read when the slot is first used.
+        """
+        loras = list(stack)
+        previous = getattr(model, "comfy_lora_stack", None)
+        meta_list, sd_list = model.comfy_lora_meta_list, model.comfy_lora_sd_list
+        del meta_list[len(loras) :]
+        del sd_list[len(loras) :]
+        for i, meta in enumerate(loras):
+            if i >= len(meta_list):
+                meta_list.append(meta)
+                sd_list.append(None)
+            elif meta[0] == meta_list[i][0] and (
+                previous is None or i >= len(previous) or previous.fingerprints[i] == stack.fingerprints[i]
+            ):
+                meta_list[i] = meta
+                continue
+            meta_list[i] = meta
+            sd_list[i] = LazyLoraStateDict(meta[0], load_state_dict_in_safetensors, "nunchaku")
+
+    def _compose(self, model, stack, lora_timings):
+        """
+        Load the slots of ``stack`` that changed on ``model`` and compose the stack.
+        """
+        if self._prepared_stack is not None:
+            # a finished background composition turns compose_lora_stack into a cache hit
+            prepared, self._prepared_stack = self._prepared_stack, None
+            with timed("prepare_wait_ms", lora_timings):
+                try:
+                    prepared.result()
+                except Exception:
+                    pass  # logged by the background task; compose in the foreground instead
+
+        composed_lora = lookup_composed(stack)
+        if composed_lora is not None:
+            # composed before (possibly by another process): the slot files are only read if
+            # a later composition needs them
+            self._sync_slot_lists(model, stack)
+            mark_applied(model, stack)
+            return composed_lora
+
+        self._sync_slot_lists(model, stack)
+        # read every slot whose file changed concurrently
+        sd_list = model.comfy_lora_sd_list
+        to_load = [i for i, sd in enumerate(sd_list) if isinstance(sd, LazyLoraStateDict) and not sd.loaded]
+        with timed("disk_load_ms", lora_timings):
+            loaded = load_loras_parallel([sd_list[i].path for i in to_load], load_state_dict_in_safetensors, "nunchaku")
+        for i, sd in zip(to_load, loaded):
+            sd_list[i] = sd
+        mark_applied(model, stack)
+
+        with timed("compose_ms", lora_timings):
+            return compose_lora_stack(stack, model.comfy_lora_sd_list, self._get_composer(model))
+
+    @staticmethod
+    def _stage_for_upload(model, params, lora_timings):
+        """
+        Upload the unquantized-part tensors of ``params`` through the pinned staging pool.
+
+        Those tensors are moved to the device as-is by ``update_lora_params``, so they are
+        copied on a side stream while it converts the quantized part on the host. The block
+        tensors, most of the bytes, are left to ``update_lora_params``, which converts them
+        before uploading. Only done for CUDA devices.
+
+        Returns
+        -------
+        params : dict
+            ``params`` with the uploaded tensors replaced, as a new dict.
+        event : torch.cuda.Event or None
+            Completion event of the upload.
+        lease : StagingLease or None
+            Staging arena to release once the upload completed.
+        """
+        pool = get_staging_pool()
+        try:
+            device = next(model.parameters()).device
+        except StopIteration:
+            return params, None, None
+        if pool is None or device.type != "cuda":
+            return params, None, None
+        host = {k: v for k, v in params.items() if "transformer_blocks" not in k and v.device.type == "cpu"}
+        if not host:
+            return params, None, None
+        with timed("stage_upload_ms", lora_timings):
+            pageable = {k: v for k, v in host.items() if not v.is_pinned()}
+            staged, lease = pool.stage(pageable)
+            uploaded, event = upload_async({**host, **staged}, device)
+        return {**params, **uploaded}, event, lease
+
+    def _update_loras(self, model, lora_timings):
+        """
+        Bring the LoRA weights of ``model`` in line with :attr:`lora_stack`.
+
+        Returns
+        -------
+        bool
+            False if the update was skipped because the PuLID weights are not ready yet.
+        """
+        get_registry().inc("lora_recompositions_total")
+        stack = self.lora_stack
+        composed_lora = self._compose(model, stack, lora_timings)
+        if len(composed_lora) == 0:
+            model.reset_lora()
+            return True
+        if self.lora_rank_cap is not None:
+            with timed("rank_truncate_ms", lora_timings):
+                composed_lora = truncate_stack_ranks(stack.key, composed_lora, self.lora_rank_cap)
+
+        if "x_embedder.lora_A.weight" in composed_lora:
+            new_in_channels = composed_lora["x_embedder.lora_A.weight"].shape[1]
+            current_in_channels = model.x_embedder.in_features
+            if new_in_channels < current_in_channels:
+                model.reset_x_embedder()
+
+        # Update LoRA parameters. PuLID cross-attention modules are detached meanwhile so
+        # the strict state dict load inside update_lora_params neither sees nor touches them.
+        params, upload_event, lease = self._stage_for_upload(model, composed_lora, lora_timings)
+        detached = _detach_pulid_ca(model) if self.pulid_pipeline is not None else []
+        try:
+            with timed("update_lora_params_ms", lora_timings):
+                try:
+                    model.update_lora_params(params)
+                except RuntimeError:
+                    if params is composed_lora:
+                        raise
+                    logger.warning("Staged LoRA parameters could not be applied, retrying from host memory")
+                    model.update_lora_params(composed_lora)
+        except RuntimeError as e:
+            if "Missing key(s) in state_dict" in str(e) and "pulid_ca" in str(e):
+                logger.debug("LoRA update failed due to missing PuLID weights, skipping LoRA update for this iteration")
+                # Skip LoRA update if PuLID weights are missing (first run issue)
+                return False
+            raise e
+        finally:
+            if lease is not None:
+                lease.release(upload_event)
+            if detached:
+                with timed("pulid_restore_ms", lora_timings):
+                    _reattach_pulid_ca(detached)
+        return True
 
     def forward(
         self,
@@ -164,233 +726,29 @@ class ComfyFluxWrapper(nn.Module):
         out : torch.Tensor
             Output tensor of the same spatial size as the input.
         """
-        if isinstance(timestep, torch.Tensor):
-            if timestep.numel() == 1:
-                timestep_float = timestep.item()
-            else:
-                timestep_float = timestep.flatten()[0].item()
-        else:
-            assert isinstance(timestep, float)
-            timestep_float = timestep
-
+        forward_start = time.perf_counter()
         model = self.model
         assert isinstance(model, NunchakuFluxTransformer2dModel)
 
-        bs, c, h_orig, w_orig = x.shape
-        patch_size = self.config.get("patch_size", 2)
-        h_len = (h_orig + (patch_size // 2)) // patch_size
-        w_len = (w_orig + (patch_size // 2)) // patch_size
-
-        img, img_ids = self.process_img(x)
-        img_tokens = img.shape[1]
-
-        ref_latents = kwargs.get("ref_latents")
-        if ref_latents is not None:
-            h = 0
-            w = 0
-            for ref in ref_latents:
-                h_offset = 0
-                w_offset = 0
-                if ref.shape[-2] + h > ref.shape[-1] + w:
-                    w_offset = w
-                else:
-                    h_offset = h
-
-                kontext, kontext_ids = self.process_img(ref, index=1, h_offset=h_offset, w_offset=w_offset)
-                img = torch.cat([img, kontext], dim=1)
-                img_ids = torch.cat([img_ids, kontext_ids], dim=1)
-                h = max(h, ref.shape[-2] + h_offset)
-                w = max(w, ref.shape[-1] + w_offset)
-
-        txt_ids = torch.zeros((bs, context.shape[1], 3), device=x.device, dtype=x.dtype)
-
         # load and compose LoRA
-        if self.loras != model.comfy_lora_meta_list:
-            lora_to_be_composed = []
-            for _ in range(max(0, len(model.comfy_lora_meta_list) - len(self.loras))):
-                model.comfy_lora_meta_list.pop()
-                model.comfy_lora_sd_list.pop()
-            for i in range(len(self.loras)):
-                meta = self.loras[i]
-                if i >= len(model.comfy_lora_meta_list):
-                    sd = load_state_dict_in_safetensors(meta[0])
-                    model.comfy_lora_meta_list.append(meta)
-                    model.comfy_lora_sd_list.append(sd)
-                elif model.comfy_lora_meta_list[i] != meta:
-                    if meta[0] != model.comfy_lora_meta_list[i][0]:
-                        sd = load_state_dict_in_safetensors(meta[0])
-                        model.comfy_lora_sd_list[i] = sd
-                    model.comfy_lora_meta_list[i] = meta
-                lora_to_be_composed.append(({k: v for k, v in model.comfy_lora_sd_list[i].items()}, meta[1]))
-
-            composed_lora = compose_lora(lora_to_be_composed)
-
-            if len(composed_lora) == 0:
-                model.reset_lora()
-            else:
-                # Save PuLID weights before LoRA update
-                pulid_weights = {}
-                print(f"DEBUG: Checking for PuLID weights before LoRA update...")
-                if hasattr(model, 'transformer_blocks') and len(model.transformer_blocks) > 0:
-                    first_block = model.transformer_blocks[0]
-                    print(f"DEBUG: First block has pulid_ca: {hasattr(first_block, 'pulid_ca')}")
-                    if hasattr(first_block, 'pulid_ca') and first_block.pulid_ca is not None:
-                        print(f"DEBUG: Saving PuLID weights from transformer_blocks.0.pulid_ca")
-                        # Save all PuLID weights
-                        for name, param in first_block.pulid_ca.named_parameters():
-                            pulid_weights[f"transformer_blocks.0.pulid_ca.{name}"] = param.data.clone()
-                        print(f"DEBUG: Saved {len(pulid_weights)} PuLID weights from transformer_blocks")
-                    # Also save from _original_blocks if it exists
-                    if hasattr(model, '_original_blocks') and len(model._original_blocks) > 0:
-                        orig_first_block = model._original_blocks[0]
-                        print(f"DEBUG: Original block has pulid_ca: {hasattr(orig_first_block, 'pulid_ca')}")
-                        if hasattr(orig_first_block, 'pulid_ca') and orig_first_block.pulid_ca is not None:
-                            print(f"DEBUG: Saving PuLID weights from _original_blocks.0.pulid_ca")
-                            for name, param in orig_first_block.pulid_ca.named_parameters():
-                                pulid_weights[f"_original_blocks.0.pulid_ca.{name}"] = param.data.clone()
-                            print(f"DEBUG: Total saved {len(pulid_weights)} PuLID weights")
-                else:
-                    print(f"DEBUG: No transformer_blocks found or empty")
-                
-                if "x_embedder.lora_A.weight" in composed_lora:
-                    new_in_channels = composed_lora["x_embedder.lora_A.weight"].shape[1]
-                    current_in_channels = model.x_embedder.in_features
-                    if new_in_channels < current_in_channels:
-                        model.reset_x_embedder()
-                
-                # Update LoRA parameters
-                try:
-                    model.update_lora_params(composed_lora)
-                except RuntimeError as e:
-                    if "Missing key(s) in state_dict" in str(e) and "pulid_ca" in str(e):
-                        print(f"DEBUG: LoRA update failed due to missing PuLID weights, skipping LoRA update for this iteration")
-                        # Skip LoRA update if PuLID weights are missing (first run issue)
-                        return self.forward_without_lora_update(x, timestep, context, y, guidance, control, transformer_options, **kwargs)
-                    else:
-                        raise e
-                
-                # Restore PuLID weights after LoRA update
-                print(f"DEBUG: Attempting to restore {len(pulid_weights)} PuLID weights...")
-                if pulid_weights:
-                    try:
-                        # Create a combined state dict with LoRA and PuLID weights
-                        combined_state_dict = {**composed_lora, **pulid_weights}
-                        print(f"DEBUG: Combined state dict has {len(combined_state_dict)} keys")
-                        model.load_state_dict(combined_state_dict, strict=False)
-                        print(f"DEBUG: Successfully restored PuLID weights using load_state_dict")
-                    except Exception as e:
-                        print(f"Warning: Failed to restore PuLID weights after LoRA update: {e}")
-                        # Try to restore PuLID weights manually
-                        print(f"DEBUG: Attempting manual restoration...")
-                        if hasattr(model, 'transformer_blocks') and len(model.transformer_blocks) > 0:
-                            first_block = model.transformer_blocks[0]
-                            if hasattr(first_block, 'pulid_ca') and first_block.pulid_ca is not None:
-                                print(f"DEBUG: Manually restoring to transformer_blocks.0.pulid_ca")
-                                for name, param in first_block.pulid_ca.named_parameters():
-                                    key = f"transformer_blocks.0.pulid_ca.{name}"
-                                    if key in pulid_weights:
-                                        param.data.copy_(pulid_weights[key])
-                        if hasattr(model, '_original_blocks') and len(model._original_blocks) > 0:
-                            orig_first_block = model._original_blocks[0]
-                            if hasattr(orig_first_block, 'pulid_ca') and orig_first_block.pulid_ca is not None:
-                                print(f"DEBUG: Manually restoring to _original_blocks.0.pulid_ca")
-                                for name, param in orig_first_block.pulid_ca.named_parameters():
-                                    key = f"_original_blocks.0.pulid_ca.{name}"
-                                    if key in pulid_weights:
-                                        param.data.copy_(pulid_weights[key])
-                else:
-                    print(f"DEBUG: No PuLID weights to restore")
-
-        controlnet_block_samples = None if control is None else [y.to(x.dtype) for y in control["input"]]
-        controlnet_single_block_samples = None if control is None else [y.to(x.dtype) for y in control["output"]]
-
-        if self.pulid_pipeline is not None:
-            self.model.transformer_blocks[0].pulid_ca = self.pulid_pipeline.pulid_ca
-
-        if getattr(model, "residual_diff_threshold_multi", 0) != 0 or getattr(model, "_is_cached", False):
-            # A more robust caching strategy
-            cache_invalid = False
-
-            # Check if timestamps have changed or are out of valid range
-            if self._prev_timestep is None:
-                cache_invalid = True
-            elif self._prev_timestep < timestep_float + 1e-5:  # allow a small tolerance to reuse the cache
-                cache_invalid = True
-
-            if cache_invalid:
-                self._cache_context = create_cache_context()
-
-            # Update the previous timestamp
-            self._prev_timestep = timestep_float
-            with cache_context(self._cache_context):
-                if self.customized_forward is None:
-                    out = model(
-                        hidden_states=img,
-                        encoder_hidden_states=context,
-                        pooled_projections=y,
-                        timestep=timestep,
-                        img_ids=img_ids,
-                        txt_ids=txt_ids,
-                        guidance=guidance if self.config["guidance_embed"] else None,
-                        controlnet_block_samples=controlnet_block_samples,
-                        controlnet_single_block_samples=controlnet_single_block_samples,
-                    ).sample
-                else:
-                    out = self.customized_forward(
-                        model,
-                        hidden_states=img,
-                        encoder_hidden_states=context,
-                        pooled_projections=y,
-                        timestep=timestep,
-                        img_ids=img_ids,
-                        txt_ids=txt_ids,
-                        guidance=guidance if self.config["guidance_embed"] else None,
-                        controlnet_block_samples=controlnet_block_samples,
-                        controlnet_single_block_samples=controlnet_single_block_samples,
-                        **self.forward_kwargs,
-                    ).sample
-        else:
-            if self.customized_forward is None:
-                out = model(
-                    hidden_states=img,
-                    encoder_hidden_states=context,
-                    pooled_projections=y,
-                    timestep=timestep,
-                    img_ids=img_ids,
-                    txt_ids=txt_ids,
-                    guidance=guidance if self.config["guidance_embed"] else None,
-                    controlnet_block_samples=controlnet_block_samples,
-                    controlnet_single_block_samples=controlnet_single_block_samples,
-                ).sample
-            else:
-                out = self.customized_forward(
-                    model,
-                    hidden_states=img,
-                    encoder_hidden_states=context,
-                    pooled_projections=y,
-                    timestep=timestep,
-                    img_ids=img_ids,
-                    txt_ids=txt_ids,
-                    guidance=guidance if self.config["guidance_embed"] else None,
-                    controlnet_block_samples=controlnet_block_samples,
-                    controlnet_single_block_samples=controlnet_single_block_samples,
-                    **self.forward_kwargs,
-                ).sample
-        if self.pulid_pipeline is not None:
-            self.model.transformer_blocks[0].pulid_ca = None
-
-        out = out[:, :img_tokens]
-        out = rearrange(
-            out,
-            "b (h w) (c ph pw) -> b c (h ph) (w pw)",
-            h=h_len,
-            w=w_len,
-            ph=patch_size,
-            pw=patch_size,
-        )
-        out = out[:, :, :h_orig, :w_orig]
-
-        self._prev_timestep = timestep_float
+        lora_timings = None
+        if not self._lora_stack_applied(model):
+            lora_timings = {}
+            self._update_loras(model, lora_timings)
+
+        out = self._run(x, timestep, context, y, guidance, control, transformer_options, **kwargs)
+
+        # host-side time: kernels may still be running asynchronously on the device
+        forward_ms = (time.perf_counter() - forward_start) * 1000.0
+        get_registry().observe("forward_ms", forward_ms)
+        if lora_timings is not None:
+            lora_timings["forward_ms"] = forward_ms
+            self.last_lora_timings = lora_timings
+            logger.debug(
+                "LoRA recomposition of %d LoRA(s): %s",
+                len(self.lora_stack),
+                ", ".join(f"{name}={ms:.1f}" for name, ms in lora_timings.items()),
+            )
         return out
 
     def forward_without_lora_update(
@@ -407,134 +765,60 @@ class ComfyFluxWrapper(nn.Module):
         """
         Forward pass without LoRA update (used when PuLID weights are not ready)
         """
-        if isinstance(timestep, torch.Tensor):
-            if timestep.numel() == 1:
-                timestep_float = timestep.item()
-            else:
-                timestep_float = timestep.flatten()[0].item()
-        else:
-            assert isinstance(timestep, float)
-            timestep_float = timestep
+        return self._run(x, timestep, context, y, guidance, control, transformer_options, **kwargs)
+
+    def _run(self, x, timestep, context, y, guidance, control, transformer_options, **kwargs):
+        """
+        Run one sampling step with the LoRA weights currently applied to the model.
 
+        Shared by :meth:`forward` and :meth:`forward_without_lora_update`.
+        """
+        assert isinstance(timestep, (torch.Tensor, float))
         model = self.model
-        assert isinstance(model, NunchakuFluxTransformer2dModel)
+        plan = self._get_call_plan()
 
         bs, c, h_orig, w_orig = x.shape
         patch_size = self.config.get("patch_size", 2)
         h_len = (h_orig + (patch_size // 2)) // patch_size
         w_len = (w_orig + (patch_size // 2)) // patch_size
 
-        img, img_ids = self.process_img(x)
-        img_tokens = img.shape[1]
-
-        ref_latents = kwargs.get("ref_latents")
-        if ref_latents is not None:
-            h = 0
-            w = 0
-            for ref in ref_latents:
-                h_offset = 0
-                w_offset = 0
-                if ref.shape[-2] + h > ref.shape[-1] + w:
-                    w_offset = w
-                else:
-                    h_offset = h
-
-                kontext, kontext_ids = self.process_img(ref, index=1, h_offset=h_offset, w_offset=w_offset)
-                img = torch.cat([img, kontext], dim=1)
-                img_ids = torch.cat([img_ids, kontext_ids], dim=1)
-                h = max(h, ref.shape[-2] + h_offset)
-                w = max(w, ref.shape[-1] + w_offset)
-
-        txt_ids = torch.zeros((bs, context.shape[1], 3), device=x.device, dtype=x.dtype)
+        img, img_ids, img_tokens = self._prepare_tokens(x, kwargs.get("ref_latents"))
+
+        txt_ids = self._get_txt_ids(bs, context.shape[1], x.device, x.dtype)
 
         controlnet_block_samples = None if control is None else [y.to(x.dtype) for y in control["input"]]
         controlnet_single_block_samples = None if control is None else [y.to(x.dtype) for y in control["output"]]
 
+        inputs = dict(
+            hidden_states=img,
+            encoder_hidden_states=context,
+            pooled_projections=y,
+            timestep=timestep,
+            img_ids=img_ids,
+            txt_ids=txt_ids,
+            controlnet_block_samples=controlnet_block_samples,
+            controlnet_single_block_samples=controlnet_single_block_samples,
+        )
+
         if self.pulid_pipeline is not None:
             self.model.transformer_blocks[0].pulid_ca = self.pulid_pipeline.pulid_ca
-
-        if getattr(model, "residual_diff_threshold_multi", 0) != 0 or getattr(model, "_is_cached", False):
-            # A more robust caching strategy
-            cache_invalid = False
-
-            # Check if timestamps have changed or are out of valid range
-            if self._prev_timestep is None:
-                cache_invalid = True
-            elif self._prev_timestep < timestep_float + 1e-5:  # allow a small tolerance to reuse the cache
-                cache_invalid = True
-
-            if cache_invalid:
-                self._cache_context = create_cache_context()
-
-            # Update the previous timestamp
-            self._prev_timestep = timestep_float
-            with cache_context(self._cache_context):
-                if self.customized_forward is None:
-                    out = model(
-                        hidden_states=img,
-                        encoder_hidden_states=context,
-                        pooled_projections=y,
-                        timestep=timestep,
-                        img_ids=img_ids,
-                        txt_ids=txt_ids,
-                        guidance=guidance if self.config["guidance_embed"] else None,
-                        controlnet_block_samples=controlnet_block_samples,
-                        controlnet_single_block_samples=controlnet_single_block_samples,
-                    ).sample
-                else:
-                    out = self.customized_forward(
-                        model,
-                        hidden_states=img,
-                        encoder_hidden_states=context,
-                        pooled_projections=y,
-                        timestep=timestep,
-                        img_ids=img_ids,
-                        txt_ids=txt_ids,
-                        guidance=guidance if self.config["guidance_embed"] else None,
-                        controlnet_block_samples=controlnet_block_samples,
-                        controlnet_single_block_samples=controlnet_single_block_samples,
-                        **self.forward_kwargs,
-                    ).sample
-        else:
-            if self.customized_forward is None:
-                out = model(
-                    hidden_states=img,
-                    encoder_hidden_states=context,
-                    pooled_projections=y,
-                    timestep=timestep,
-                    img_ids=img_ids,
-                    txt_ids=txt_ids,
-                    guidance=guidance if self.config["guidance_embed"] else None,
-                    controlnet_block_samples=controlnet_block_samples,
-                    controlnet_single_block_samples=controlnet_single_block_samples,
-                ).sample
+        try:
+            # the threshold is set on the model by the caching nodes and may change between runs
+            if getattr(model, "residual_diff_threshold_multi", 0) != 0 or getattr(model, "_is_cached", False):
+                fb_context = self.fbcache_policy.context_for(
+                    transformer_options, timestep, self.lora_stack, bs
+                )
+                with cache_context(fb_context):
+                    out = plan(model, guidance, **inputs)
             else:
-                out = self.customized_forward(
-                    model,
-                    hidden_states=img,
-                    encoder_hidden_states=context,
-                    pooled_projections=y,
-                    timestep=timestep,
-                    img_ids=img_ids,
-                    txt_ids=txt_ids,
-                    guidance=guidance if self.config["guidance_embed"] else None,
-                    controlnet_block_samples=controlnet_block_samples,
-                    controlnet_single_block_samples=controlnet_single_block_samples,
-                    **self.forward_kwargs,
-                ).sample
-        if self.pulid_pipeline is not None:
-            self.model.transformer_blocks[0].pulid_ca = None
-
-        out = out[:, :img_tokens]
-        out = rearrange(
-            out,
-            "b (h w) (c ph pw) -> b c (h ph) (w pw)",
-            h=h_len,
-            w=w_len,
-            ph=patch_size,
-            pw=patch_size,
-        )
-        out = out[:, :, :h_orig, :w_orig]
+                out = plan(model, guidance, **inputs)
+        finally:
+            if self.pulid_pipeline is not None:
+                self.model.transformer_blocks[0].pulid_ca = None
+
+        # single allocation; cropping the padding is a view
+        out = _unpatchify(out, h_len, w_len, patch_size)
+        if out.shape[-2] != h_orig or out.shape[-1] != w_orig:
+            out = out[:, :, :h_orig, :w_orig]
 
-        self._prev_timestep = timestep_float
         return out